@@ -5,15 +5,7 @@
 
 __author__ = """Shengwei Hou"""
 __email__ = 'housw2010@gmail.com'
-def version():
-    """Read program version from file."""
-    import readcounter
-    import os
-    version_file = open(os.path.join(readcounter.__path__[0], 'VERSION'), "r")
-    _version = version_file.readline().strip()
-    version_file.close()
-    return _version
-__version__ = version()
+__version__ = '0.1.0'
 
 
 from .readcounter import (
@@ -21,6 +13,21 @@ from .readcounter import (
     FastaReadCounter,
     FastqReadCounter,
     FastqcReadCounter,
-    BamReadCounter,
     CounterDispatcher,
 )
+
+
+# names imported on first access: BamReadCounter pulls in pysam, numpy and
+# pandas, and the library API is not needed by the command line
+_lazy_attributes = {"BamReadCounter": ".bam",
+                    "count": ".api",
+                    "count_many": ".api",
+                    "CountResult": ".api"
+                    }
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        import importlib
+        return getattr(importlib.import_module(_lazy_attributes[name], __name__), name)
+    raise AttributeError("module {mod!r} has no attribute {name!r}".format(mod=__name__, name=name))
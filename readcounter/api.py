@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Library API for counting reads from Python.
+
+Unlike the command line, these functions never write output files and never
+run shell commands, so they can be called in tight loops and from threads.
+Unindexed bam files are read in a single pass instead of being indexed,
+counting per region needs an existing index, e.g.,
+
+    >>> from readcounter import count, count_many
+    >>> count("sample.fq.gz", min_read_len=50).numreads
+    >>> for result in count_many(paths, workers=8):
+    ...     print(result.path, result.numreads)
+"""
+
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .readcounter import CounterDispatcher
+from .utils import guess_compress_type, guess_format
+
+
+_logger = logging.getLogger(__name__)
+
+
+class CountResult(object):
+    """Counting result of a single input file.
+
+    Attributes:
+        path (str): input file
+        format (str): input file format
+        numreads (int): number of reads, summed over `records` for bam input
+        records (list): result records, see `ReadCounter.to_records`
+        error (Exception): the exception raised while counting, or None
+    """
+
+    __slots__ = ("path", "format", "numreads", "records", "error")
+
+    def __init__(self, path, format, records=None, error=None):
+        self.path = path
+        self.format = format
+        self.records = records or []
+        self.numreads = sum(record["numreads"] for record in self.records)
+        self.error = error
+
+    @property
+    def ok(self):
+        """whether counting succeeded"""
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return "CountResult({path!r}, {format!r}, error={err!r})".format(path=self.path, format=self.format,
+                                                                             err=self.error)
+        return "CountResult({path!r}, {format!r}, numreads={numreads})".format(path=self.path, format=self.format,
+                                                                               numreads=self.numreads)
+
+
+def count(path, format=None, compress_type=None, **filters):
+    """Count reads of a single input file.
+
+    Args:
+        path (str): input file, or fastqc folder
+        format (str): one of `fasta`, `fastq`, `fastqc`, `bam` or `sam`, guessed from `path` if None
+        compress_type (str): one of `none`, `gz`, `bz2` or `zip`, guessed from `path` if None
+        filters: thresholds of the counter, e.g., `min_read_len` or `min_map_qual`
+
+    Returns:
+        a `CountResult`
+
+    Raises:
+        ValueError: if the format cannot be guessed, `use_bamcov` is requested, or
+            `regions` are given for a bam file without index
+        FormatError: if the input is malformed or truncated
+    """
+    if format is None:
+        format = guess_format(path)
+    if compress_type is None:
+        compress_type = guess_compress_type(path)
+    if filters.get("use_bamcov", False):
+        raise ValueError("use_bamcov runs an external program and is not available from the library API")
+    if format in ("bam", "sam"):
+        # never write an index next to the input
+        filters = dict(filters, build_index=False)
+    counter = CounterDispatcher(path, None, format=format, compress_type=compress_type, **filters)
+    counter.count_read_number()
+    return CountResult(path, format, list(counter.to_records()))
+
+
+def count_many(paths, format=None, workers=4, **filters):
+    """Count reads of many input files on a thread pool, yielding results as they complete.
+
+    Failures do not stop the iteration, they are reported in `CountResult.error`.
+    At most `2 * workers` inputs are in flight, so `paths` may be a lazy iterable.
+
+    Args:
+        paths (iterable): input files
+        format (str): input file format, guessed per file if None
+        workers (int): number of threads
+        filters: thresholds of the counters, see `count`
+
+    Yields:
+        `CountResult` objects, in order of completion
+    """
+
+    def _count(path):
+        try:
+            return count(path, format=format, **filters)
+        except Exception as e:
+            _logger.error("failed to count {path}: {err}".format(path=path, err=e))
+            return CountResult(path, format, error=e)
+
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while True:
+            for path in paths:
+                pending.add(executor.submit(_count, path))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+
+"""Read counting for alignment files in bam/sam format."""
+
+
+import os
+import shutil
+import logging
+import tempfile
+import subprocess
+from array import array
+from subprocess import PIPE
+import pysam
+import numpy as np
+import pandas as pd
+from .readcounter import ReadCounter
+from .utils import parse_size
+
+
+_logger = logging.getLogger(__name__)
+
+
+# entries of the working buffers (8 bytes each), by default and in low-memory mode
+_BUFFER_SIZE = 1 << 20
+_LOW_MEMORY_BUFFER_SIZE = 1 << 16
+
+
+class _SparseCounter(object):
+    """Count occurrences of int64 keys in bounded memory.
+
+    Keys are buffered in a fixed-size array and folded into sorted arrays of
+    unique keys and their counts whenever the buffer is full, so memory grows
+    with the number of distinct keys only, at 16 bytes per key.
+    """
+
+    def __init__(self, buffer_size=_BUFFER_SIZE):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._buffer = np.empty(buffer_size, dtype=np.int64)
+        self._n = 0
+
+    def add(self, key):
+        self._buffer[self._n] = key
+        self._n += 1
+        if self._n == len(self._buffer):
+            self._fold()
+
+    def _fold(self):
+        keys, counts = np.unique(self._buffer[:self._n], return_counts=True)
+        self._n = 0
+        if len(self.keys):
+            keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts])).astype(np.int64)
+        self.keys, self.counts = keys, counts
+
+    def result(self):
+        """Returns:
+            sorted unique keys and their counts
+        """
+        self._fold()
+        return self.keys, self.counts
+
+
+class _ContigTable(object):
+    """contig/length/numreads rows of a bam result in compact arrays.
+
+    Contig names are stored back to back in a single buffer, lengths and counts
+    in int64 arrays, i.e., about the name length plus 24 bytes per row instead of
+    the Python objects of a DataFrame row. Provides the `itertuples` and `to_csv`
+    methods of the DataFrame it stands in for, `to_csv` streams the rows.
+    """
+
+    columns = ['contig', 'length', 'numreads']
+
+    def __init__(self, rows=()):
+        self._names = bytearray()
+        self._name_ends = array('q')
+        self.lengths = array('q')
+        self.numreads = array('q')
+        for contig, length, numreads in rows:
+            self.append(contig, length, numreads)
+
+    def append(self, contig, length, numreads):
+        self._names += contig.encode("utf-8")
+        self._name_ends.append(len(self._names))
+        self.lengths.append(length)
+        self.numreads.append(numreads)
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def itertuples(self, index=False):
+        start = 0
+        for end, length, numreads in zip(self._name_ends, self.lengths, self.numreads):
+            yield self._names[start:end].decode("utf-8"), length, numreads
+            start = end
+
+    def to_csv(self, path_or_buf, sep='\t', header=True, index=False):
+        with open(path_or_buf, "w") as oh:
+            if header:
+                oh.write(sep.join(self.columns) + "\n")
+            for contig, length, numreads in self.itertuples():
+                oh.write("{0}{sep}{1}{sep}{2}\n".format(contig, length, numreads, sep=sep))
+
+
+class RegionIndex(object):
+    """Regions of a BED file, indexed per contig.
+
+    Regions of each contig are kept sorted by start in arrays, together with
+    the merged spans covered by one or more overlapping regions.
+
+    Attributes:
+        contigs (list): contigs in order of their first region in the BED file
+        starts, ends (dict): contig to sorted region starts and ends (0-based, half-open)
+        names (dict): contig to region names, in the same order
+        spans (dict): contig to list of (start, end) of merged, non-overlapping spans
+    """
+
+    def __init__(self, regions):
+        """ To initialize a RegionIndex object
+
+        Args:
+            regions (iterable): (contig, start, end, name) tuples
+        """
+        by_contig = {}
+        for contig, start, end, name in regions:
+            by_contig.setdefault(contig, []).append((start, end, name))
+        self.contigs = list(by_contig)
+        self.starts, self.ends, self.names, self.spans = {}, {}, {}, {}
+        for contig, contig_regions in by_contig.items():
+            contig_regions.sort(key=lambda region: region[:2])
+            self.starts[contig] = np.array([region[0] for region in contig_regions], dtype=np.int64)
+            self.ends[contig] = np.array([region[1] for region in contig_regions], dtype=np.int64)
+            self.names[contig] = [region[2] for region in contig_regions]
+            spans = []
+            for start, end, _ in contig_regions:
+                if spans and start <= spans[-1][1]:
+                    spans[-1][1] = max(spans[-1][1], end)
+                else:
+                    spans.append([start, end])
+            self.spans[contig] = [tuple(span) for span in spans]
+
+    @classmethod
+    def from_bed(cls, bed_file):
+        """Load regions from a BED file, unnamed regions are named `contig:start-end`."""
+        def parse():
+            with open(bed_file) as fh:
+                for line in fh:
+                    if not line.strip() or line.startswith(("#", "track", "browser")):
+                        continue
+                    fields = line.rstrip("\n").split("\t")
+                    contig, start, end = fields[0], int(fields[1]), int(fields[2])
+                    name = fields[3] if len(fields) > 3 and fields[3] else "{0}:{1}-{2}".format(contig, start, end)
+                    yield contig, start, end, name
+        return cls(parse())
+
+    def count(self, contig, read_starts, read_ends):
+        """Count the reads overlapping each region of `contig`.
+
+        A read overlaps a region if it starts before the region ends and ends after
+        the region starts, so the count is the number of reads starting before the
+        region end minus the number of reads ending at or before the region start.
+
+        Args:
+            contig (str): contig name
+            read_starts, read_ends (numpy.ndarray): reference start and end of the reads of `contig`
+
+        Returns:
+            numpy.ndarray of read counts, in the order of `starts[contig]`
+        """
+        read_starts = np.sort(read_starts)
+        read_ends = np.sort(read_ends)
+        return (np.searchsorted(read_starts, self.ends[contig], side='left') -
+                np.searchsorted(read_ends, self.starts[contig], side='right'))
+
+
+class BamReadCounter(ReadCounter):
+
+    format = "bam"
+
+    def __init__(self, input_file, out_file, compress_type="none", min_read_len=0, min_aln_len=0, min_map_qual=0, min_base_qual=0, use_bamcov=False, pysam_mem='10G', group_by_tag=None, regions=None, low_memory=False, max_memory=None, build_index=True):
+        try:
+            super().__init__(input_file, out_file, compress_type)
+        except Exception as e:
+            _logger.warning("Python3 is not supported by your interpreter: {err_msg}, using Python2 instead".format(err_msg=e))
+            super(BamReadCounter, self).__init__(input_file, out_file, compress_type)
+        self.min_read_len = min_read_len
+        self.min_aln_len = min_aln_len
+        self.min_map_qual = min_map_qual
+        self.min_base_qual = min_base_qual
+        self.use_bamcov = use_bamcov
+        self.group_by_tag = group_by_tag
+        self.regions = regions
+        self.build_index = build_index
+        self.low_memory = low_memory
+        self.max_memory = parse_size(max_memory) if isinstance(max_memory, str) else max_memory
+        if group_by_tag and regions:
+            raise ValueError("counting per tag value and per region at the same time is not supported")
+
+    # opened AlignmentFile handles keyed by (path, mtime, size), long-running
+    # processes (see `readcounter.server`) set this to an OrderedDict to reuse
+    # indexes, at most `samfile_cache_size` handles are kept open
+    samfile_cache = None
+    samfile_cache_size = 32
+
+    def _open_samfile(self):
+        if self.samfile_cache is None:
+            return pysam.AlignmentFile(self.input_file, "rb")
+        stat = os.stat(self.input_file)
+        path = os.path.realpath(self.input_file)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        samfile = self.samfile_cache.get(key, None)
+        if samfile is not None:
+            self.samfile_cache.move_to_end(key)
+            return samfile
+        # the file changed since it was opened, or the cache is full
+        stale = [k for k in self.samfile_cache if k[0] == path]
+        while len(self.samfile_cache) - len(stale) >= self.samfile_cache_size:
+            stale.append(next(k for k in self.samfile_cache if k not in stale))
+        for k in stale:
+            self.samfile_cache.pop(k).close()
+        samfile = pysam.AlignmentFile(self.input_file, "rb")
+        self.samfile_cache[key] = samfile
+        return samfile
+
+    def _get_depth_per_bam_file_via_bamcov(self):
+
+        # create tmp dir and file to save bamcov result
+        input_basename = os.path.basename(self.input_file)
+        input_filestem = os.path.splitext(input_basename)[0]
+        tmp_bamcov_dir = tempfile.mkdtemp()
+        tmp_bamcov_file = os.path.join(tmp_bamcov_dir, input_filestem+"_bamcov.tsv")
+        try:
+            self._run_bamcov(tmp_bamcov_file)
+            # parse the bamcov table line by line, keeping non-empty contigs only
+            table = _ContigTable()
+            with open(tmp_bamcov_file) as fh:
+                columns = fh.readline().rstrip("\n").split("\t")
+                rname, endpos, numreads = (columns.index(c) for c in ('#rname', 'endpos', 'numreads'))
+                for line in fh:
+                    fields = line.rstrip("\n").split("\t")
+                    if int(fields[numreads]):
+                        table.append(fields[rname], int(fields[endpos]), int(fields[numreads]))
+            return table
+        finally:
+            shutil.rmtree(tmp_bamcov_dir, ignore_errors=True)
+
+    def _run_bamcov(self, tmp_bamcov_file):
+
+        self._ensure_index()
+
+        _logger.info("min_read_len is: "+ str(self.min_read_len))
+        # command for bamcov
+        cmd = ['bamcov', '--output', tmp_bamcov_file,
+               '--min-read-len', str(self.min_read_len),
+               '--min-MQ', str(self.min_map_qual),
+               '--min-BQ', str(self.min_base_qual),
+               self.input_file]
+        _logger.info("counting mapped reads using bamcov")
+        _logger.info("[bamcov commandline] {c}".format(c=" ".join(cmd)))
+        try:
+            p = subprocess.Popen(cmd, shell=False, stdout=PIPE, stderr=PIPE)
+            output, err = p.communicate()
+        except Exception as e:
+            _logger.warning("It seems like your bam file is not sorted, trying to sort it and run bamcov again ...")
+            try:
+                tmp_file = tempfile.mkstemp()[1]
+                _logger.debug(tmp_file)
+                pysam.sort("-o", tmp_file, self.input_file)
+                shutil.move(tmp_file, self.input_file)
+                pysam.index(self.input_file)
+                ret_code = subprocess.check_call(cmd, shell=False)
+            except Exception as e:
+                raise Exception("failed to call bamcov, try to debug in terminal with this command {cmd}".format(cmd=" ".join(cmd)))
+
+    def filter_read(self, aln):
+        # possible filters
+        # aln.is_paired=True
+        # np.mean(aln.query_alignment_qualities[1])=30
+        if ((not aln.is_unmapped) and (not aln.is_duplicate) and (not aln.is_qcfail) and 
+            (not aln.is_secondary) and 
+            (not aln.is_supplementary) and 
+            (aln.query_length >= self.min_read_len) and 
+            (aln.mapping_quality >= self.min_map_qual) and 
+            (self.min_base_qual <= 0 or
+             (aln.query_qualities is not None and np.mean(aln.query_qualities) >= self.min_base_qual)) and 
+            (aln.query_alignment_length >= self.min_aln_len)):
+            return True
+        else:
+            return False
+
+    def _get_depth_per_tag_value(self):
+        """ get read count for each (contig, tag value) pair in a single pass"""
+
+        samfile = self._open_samfile()
+        samfile.reset()
+        tag = self.group_by_tag
+        codes = {}
+        counter = _SparseCounter(self._buffer_size())
+        untagged = 0
+        _logger.info("counting mapped reads per contig and {tag} tag using pysam".format(tag=tag))
+        for aln in samfile.fetch(until_eof=True):
+            if not self.filter_read(aln):
+                continue
+            try:
+                value = aln.get_tag(tag)
+            except KeyError:
+                untagged += 1
+                continue
+            code = codes.get(value, None)
+            if code is None:
+                code = codes[value] = len(codes)
+            # tag code in the high, contig id in the low 32 bits
+            counter.add((code << 32) | aln.reference_id)
+        if untagged:
+            _logger.info("skipped {n} reads without {tag} tag".format(n=untagged, tag=tag))
+
+        keys, numreads = counter.result()
+        order = np.lexsort((keys >> 32, keys & 0xFFFFFFFF))
+        keys, numreads = keys[order], numreads[order]
+        # look up the contigs with reads only, and keep contigs and tag values as categoricals
+        tids, contig_codes = np.unique(keys & 0xFFFFFFFF, return_inverse=True)
+        names = [samfile.get_reference_name(int(tid)) for tid in tids]
+        lengths = np.array([samfile.get_reference_length(name) for name in names], dtype=np.int64)
+        return pd.DataFrame({'#rname': pd.Categorical.from_codes(contig_codes, categories=names),
+                             'endpos': lengths[contig_codes],
+                             tag: pd.Categorical.from_codes(keys >> 32, categories=list(codes)),
+                             'numreads': numreads})
+
+    def _get_depth_per_region(self):
+        """ get read count for each region of a BED file, walking the reads of each contig once"""
+
+        index = RegionIndex.from_bed(self.regions)
+        if not self._ensure_index():
+            raise ValueError("counting reads per region needs an indexed bam file, "
+                             "{path}.bai is missing".format(path=self.input_file))
+        samfile = self._open_samfile()
+        known = set(samfile.references)
+
+        _logger.info("counting mapped reads per region using pysam")
+        buffer_size = self._buffer_size()
+        frames = []
+        for contig in index.contigs:
+            numreads = np.zeros(len(index.starts[contig]), dtype=np.int64)
+            read_starts, read_ends = array('q'), array('q')
+            if contig in known:
+                # a single index seek per contig, reads come sorted by start, so the first
+                # span ending after a read start tells whether the read falls between spans
+                spans = index.spans[contig]
+                k = 0
+                for aln in samfile.fetch(contig, spans[0][0], spans[-1][1]):
+                    if aln.is_unmapped:
+                        continue
+                    while k < len(spans) and spans[k][1] <= aln.reference_start:
+                        k += 1
+                    if k == len(spans):
+                        break
+                    if aln.reference_end <= spans[k][0] or not self.filter_read(aln):
+                        continue
+                    read_starts.append(aln.reference_start)
+                    read_ends.append(aln.reference_end)
+                    # overlap counts add up, count the buffered reads whenever the buffer is full
+                    if len(read_starts) == buffer_size:
+                        numreads += index.count(contig, np.frombuffer(read_starts, dtype=np.int64),
+                                                np.frombuffer(read_ends, dtype=np.int64))
+                        read_starts, read_ends = array('q'), array('q')
+            else:
+                _logger.warning("contig {contig} of the regions is not in the bam file".format(contig=contig))
+            numreads += index.count(contig, np.frombuffer(read_starts, dtype=np.int64),
+                                    np.frombuffer(read_ends, dtype=np.int64))
+            frames.append(pd.DataFrame({'#rname': contig, 'start': index.starts[contig], 'end': index.ends[contig],
+                                        'name': index.names[contig], 'numreads': numreads}))
+        if not frames:
+            return pd.DataFrame(columns=['#rname', 'start', 'end', 'name', 'numreads'])
+        df = pd.concat(frames, ignore_index=True)
+        df['#rname'] = df['#rname'].astype('category')
+        return df
+
+    def _get_depth_per_bam_file(self):
+        """ get read count for each non-empty contig"""
+
+        filter_read = self.filter_read
+
+        if not self._ensure_index():
+            return self._get_depth_per_unindexed_bam_file()
+
+        samfile = self._open_samfile()
+        _logger.info("counting mapped reads using pysam")
+        # look up names and lengths one contig at a time, instead of materializing the header,
+        # and keep non-empty contigs only
+        table = _ContigTable()
+        for tid in range(samfile.nreferences):
+            contig = samfile.get_reference_name(tid)
+            length = samfile.get_reference_length(contig)
+            count = samfile.count(contig=contig, start=0, stop=length, region=None, until_eof=False,
+                                  read_callback=filter_read)
+            if count:
+                table.append(contig, length, count)
+        return table
+
+    def _get_depth_per_unindexed_bam_file(self):
+        """ get read count for each non-empty contig in a single pass over an unindexed bam file"""
+
+        samfile = self._open_samfile()
+        samfile.reset()
+        _logger.info("counting mapped reads of the unindexed bam file in a single pass using pysam")
+        numreads = [0] * samfile.nreferences
+        for aln in samfile.fetch(until_eof=True):
+            if aln.reference_id >= 0 and self.filter_read(aln):
+                numreads[aln.reference_id] += 1
+        table = _ContigTable()
+        for tid, count in enumerate(numreads):
+            if count:
+                contig = samfile.get_reference_name(tid)
+                table.append(contig, samfile.get_reference_length(contig), count)
+        return table
+
+    def _ensure_index(self):
+        """ index the input bam file if needed and allowed by `build_index`, returns whether it is indexed"""
+        if os.path.exists(self.input_file + ".bai"):
+            return True
+        if not self.build_index:
+            return False
+        _logger.info("indexing input bam file")
+        pysam.index(self.input_file)
+        return True
+
+    def _buffer_size(self):
+        """number of entries of the working buffers, smaller with `low_memory` or a `max_memory` budget"""
+        size = _LOW_MEMORY_BUFFER_SIZE if self.low_memory else _BUFFER_SIZE
+        if self.max_memory:
+            # keep each buffer within a small share of the budget
+            size = min(size, max(1024, self.max_memory // 64))
+        return int(size)
+
+    def count_read_number(self):
+        """This function implement read counting for input files in bam format.
+
+        With `group_by_tag`, e.g., `RG` or `CB`, reads are counted per contig and tag value
+        in a single pass, reads without the tag are skipped.
+        With `regions`, a BED file, reads are counted per region, a read is counted
+        for every region it overlaps.
+        Counts per contig are kept for non-empty contigs only, in compact arrays (see `_ContigTable`),
+        contigs and tag values of grouped counts as categoricals. Working buffers (tag keys,
+        read coordinates per region) hold at most 1M entries, fewer with `low_memory` or a
+        `max_memory` budget, and `to_records` yields records one at a time.
+        """
+        if self.regions:
+            if self.use_bamcov:
+                _logger.warning("bamcov can not count reads per region, use pysam instead")
+            df = self._get_depth_per_region()
+            selected_df = df[['#rname', 'start', 'end', 'name', 'numreads']]
+            selected_df.columns = ['contig', 'start', 'end', 'name', 'numreads']
+            self.read_count = selected_df
+            return
+        if self.group_by_tag:
+            if self.use_bamcov:
+                _logger.warning("bamcov can not group reads by tag, use pysam instead")
+            df = self._get_depth_per_tag_value()
+            selected_df = df[['#rname', 'endpos', self.group_by_tag, 'numreads']]
+            selected_df.columns = ['contig', 'length', self.group_by_tag, 'numreads']
+            self.read_count = selected_df
+            return
+        if self.use_bamcov and self.min_base_qual > 0:
+            _logger.warning("bamcov applies --min_base_qual to each base, not to the mean read quality, "
+                            "use pysam instead")
+        if self.use_bamcov and self.min_base_qual <= 0:
+            try: 
+                self.read_count = self._get_depth_per_bam_file_via_bamcov()
+            except Exception as e:
+                _logger.error("it seems bamcov doesn't work for you, use pysam instead")
+                self.read_count = self._get_depth_per_bam_file()
+        else:
+            self.read_count = self._get_depth_per_bam_file()
+
+    def write(self):
+        self.read_count.to_csv(path_or_buf=self.out_file, sep='\t', header=True, index=False)
+
+    def to_records(self):
+        """Yield the counting result one record at a time, see `ReadCounter.to_records`."""
+        sample = self.output_filestem
+        if self.regions:
+            for contig, start, end, name, numreads in self.read_count.itertuples(index=False):
+                yield {"sample": sample, "format": self.format, "contig": contig, "start": int(start),
+                       "end": int(end), "length": int(end - start), "region": name, "numreads": int(numreads)}
+        elif self.group_by_tag:
+            for contig, length, group, numreads in self.read_count.itertuples(index=False):
+                yield {"sample": sample, "format": self.format, "contig": contig, "length": int(length),
+                       "group": str(group), "numreads": int(numreads)}
+        else:
+            for contig, length, numreads in self.read_count.itertuples(index=False):
+                yield {"sample": sample, "format": self.format, "contig": contig, "length": int(length),
+                       "numreads": int(numreads)}
+
+    def load_records(self, records):
+        if self.regions:
+            self.read_count = pd.DataFrame([(r["contig"], r["start"], r["end"], r["region"], r["numreads"]) for r in records],
+                                           columns=['contig', 'start', 'end', 'name', 'numreads'])
+            return
+        if self.group_by_tag:
+            self.read_count = pd.DataFrame([(r["contig"], r["length"], r["group"], r["numreads"]) for r in records],
+                                           columns=['contig', 'length', self.group_by_tag, 'numreads'])
+            return
+        self.read_count = _ContigTable((r["contig"], r["length"], r["numreads"]) for r in records)
@@ -7,11 +7,14 @@ import os
 import sys
 import click
 import logging
+from . import __version__
 from .readcounter import CounterDispatcher
+from .scanner import FormatError
 from .utils import make_output_file
 from .utils import add_options
 from .utils import guess_compress_type
 from .utils import setup_logging
+from .utils import validate_size
 
 
 _logger = logging.getLogger(__name__)
@@ -23,10 +26,42 @@ shared_options = [
     click.option('-o', '--output_dir', help="output directory", default="./", show_default=True), 
     click.option('-f', '--force', is_flag=True, default=False, help="force to overwrite the output file"), 
     click.option('-l', '--loglevel', default='info', type=click.Choice(['critical', 'error', 'warning', 'info', 'debug'])),
-    click.version_option(version="0.1.0", prog_name="readcounter", message="%(prog)s, version %(version)s")
+    click.option('-O', '--output_format', default='text', show_default=True, help="output format",
+                 type=click.Choice(['text', 'jsonl', 'tsv', 'parquet', 'feather'])),
+    click.option('-a', '--append', is_flag=True, default=False,
+                 help="append to an existing output file, needs a jsonl/tsv/parquet/feather output format"),
+    click.version_option(version=__version__, prog_name="readcounter", message="%(prog)s, version %(version)s")
 ]
 
 
+def counter_params(format, options):
+    """select the counter options that apply to `format`"""
+    if format in ('bam', 'sam'):
+        return options
+    if format == 'fastq':
+        return {key: options[key] for key in ('min_read_len', 'min_base_qual')}
+    return {}
+
+
+def output_suffix(output_format, append):
+    """output file suffix of `output_format`"""
+    if output_format == 'text':
+        if append:
+            raise click.UsageError("--append needs a jsonl, tsv, parquet or feather output format")
+        return ".txt"
+    from .writers import writer_map
+    return writer_map[output_format].suffix
+
+
+def write_result(counter, output_file, output_format, append):
+    """write the result of `counter` in `output_format`"""
+    if output_format == 'text':
+        counter.write()
+    else:
+        from .writers import get_writer
+        get_writer(output_format, output_file, append=append).write(counter.to_records())
+
+
 def emit_subcommand_info(subcommand, loglevel):
     setup_logging(loglevel)
     _logger.info('invoking {0} subcommand'.format(subcommand))
@@ -34,62 +69,195 @@ def emit_subcommand_info(subcommand, loglevel):
 
 @click.command()
 @add_options(shared_options)
-def fasta(input_file, prefix, output_dir, force, loglevel):
+def fasta(input_file, prefix, output_dir, force, loglevel, output_format, append):
     emit_subcommand_info("fasta", loglevel)
-    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=".txt")
+    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=output_suffix(output_format, append),
+                                   append=append)
     compress_type = guess_compress_type(input_file)
     _logger.info('the compress type is ' + compress_type)
     # read counting
     counter = CounterDispatcher(input_file, output_file, format="fasta", compress_type=compress_type)
-    counter.count_read_number()
-    counter.write()
+    try:
+        counter.count_read_number()
+    except FormatError as e:
+        raise click.ClickException("invalid fasta input {input_file}: {err}".format(input_file=input_file, err=e))
+    write_result(counter, output_file, output_format, append)
+
+
+fastq_options = [
+    click.option('--min_read_len', help="minimum read length", type=int, default=0, show_default=True),
+    click.option('--min_base_qual', help="minimum mean base quality", type=int, default=0, show_default=True),
+]
 
 
 @click.command()
+@add_options(fastq_options)
+@click.option('-w', '--workers', help="number of worker processes, each counting a byte range of an uncompressed input",
+              type=int, default=1, show_default=True)
 @add_options(shared_options)
-def fastq(input_file, prefix, output_dir, force, loglevel):
+def fastq(input_file, prefix, output_dir, force, loglevel, output_format, append, min_read_len, min_base_qual, workers):
     emit_subcommand_info("fastq", loglevel)
-    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=".txt")
+    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=output_suffix(output_format, append),
+                                   append=append)
     compress_type = guess_compress_type(input_file)
     _logger.info('the compress type is ' + compress_type)
     # read counting
-    counter = CounterDispatcher(input_file, output_file, format="fastq", compress_type=compress_type)
-    counter.count_read_number()
-    counter.write()
+    counter = CounterDispatcher(input_file, output_file, format="fastq", compress_type=compress_type,
+                                min_read_len=min_read_len, min_base_qual=min_base_qual, workers=workers)
+    try:
+        counter.count_read_number()
+    except FormatError as e:
+        raise click.ClickException("invalid fastq input {input_file}: {err}".format(input_file=input_file, err=e))
+    write_result(counter, output_file, output_format, append)
 
 
 @click.command()
 @add_options(shared_options)
-def fastqc(input_file, prefix, output_dir, force, loglevel):
+def fastqc(input_file, prefix, output_dir, force, loglevel, output_format, append):
     emit_subcommand_info("fastqc", loglevel)
-    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=".txt")
+    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=output_suffix(output_format, append),
+                                   append=append)
     compress_type = guess_compress_type(input_file)
     _logger.info('the compress type is ' + compress_type)
     # read counting
     counter = CounterDispatcher(input_file, output_file, format="fastqc", compress_type=compress_type)
-    counter.count_read_number()
-    counter.write()
+    try:
+        counter.count_read_number()
+    except FormatError as e:
+        raise click.ClickException("invalid fastqc input {input_file}: {err}".format(input_file=input_file, err=e))
+    write_result(counter, output_file, output_format, append)
+
+
+bam_options = [
+    click.option('--min_read_len', help="minimum read length", type=int, default=0, show_default=True),
+    click.option('--min_aln_len', help="minimum alignment length", type=int, default=0, show_default=True),
+    click.option('--min_map_qual', help="minimum mapping quality", type=int, default=0, show_default=True),
+    click.option('--min_base_qual', help="minimum mean base quality of a read", type=int, default=0, show_default=True),
+    click.option('--use_bamcov', is_flag=True, default=False, help="use bamcov for read counting", show_default=True),
+    click.option('--pysam_mem', help="maximum pysam memory", type=str, default='10G', show_default=True),
+    click.option('--group_by_tag', help="count reads per contig and value of this tag, e.g., RG or CB", type=str, default=None),
+    click.option('--regions', help="BED file, count reads per region instead of per contig",
+                 type=click.Path(exists=True, dir_okay=False), default=None),
+    click.option('--low_memory', is_flag=True, default=False,
+                 help="keep working buffers small (64K entries), results are always kept in compact arrays"),
+    click.option('--max_memory', help="memory budget of the working buffers, e.g., 4G",
+                 type=str, default=None, callback=validate_size),
+]
 
 
 @click.command()
-@click.option('--min_read_len', help="minimum read length", type=int, default=0, show_default=True)
-@click.option('--min_aln_len', help="minimum alignment length", type=int, default=0, show_default=True)
-@click.option('--min_map_qual', help="minimum mapping quality", type=int, default=0, show_default=True)
-@click.option('--min_base_qual', help="minimum base quality", type=int, default=0, show_default=True)
-@click.option('--use_bamcov', is_flag=True, default=False, help="use bamcov for read counting", show_default=True)
-@click.option('--pysam_mem', help="maximum pysam memory", type=str, default='10G', show_default=True)
+@add_options(bam_options)
 @add_options(shared_options)
-def bam(input_file, prefix, output_dir, force, loglevel, min_read_len, min_aln_len, min_map_qual, min_base_qual, use_bamcov, pysam_mem):
+def bam(input_file, prefix, output_dir, force, loglevel, output_format, append, min_read_len, min_aln_len, min_map_qual, min_base_qual, use_bamcov, pysam_mem, group_by_tag, regions, low_memory, max_memory):
     emit_subcommand_info("bam", loglevel)
-    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=".txt")
+    if group_by_tag and regions:
+        raise click.UsageError("--group_by_tag and --regions can not be combined")
+    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=output_suffix(output_format, append),
+                                   append=append)
     compress_type = guess_compress_type(input_file)
     _logger.info('the compress type is ' + compress_type)
     # read counting
     counter = CounterDispatcher(input_file, output_file, format="bam", compress_type=compress_type, 
     min_read_len=min_read_len, min_aln_len=min_aln_len, min_map_qual=min_map_qual, 
-    min_base_qual=min_base_qual, use_bamcov=use_bamcov, pysam_mem=pysam_mem)
+    min_base_qual=min_base_qual, use_bamcov=use_bamcov, pysam_mem=pysam_mem, group_by_tag=group_by_tag, regions=regions,
+    low_memory=low_memory, max_memory=max_memory)
     counter.count_read_number()
-    counter.write()
+    write_result(counter, output_file, output_format, append)
+
+
+@click.command()
+@click.option('-s', '--socket', 'socket_path', help="path of the server socket", type=str, default=None)
+@click.option('-w', '--workers', help="number of worker processes  [default: number of CPUs]", type=int, default=None)
+@click.option('-l', '--loglevel', default='info', type=click.Choice(['critical', 'error', 'warning', 'info', 'debug']))
+def serve(socket_path, workers, loglevel):
+    """keep warm counting workers behind a local socket"""
+    from .server import CountingServer, DEFAULT_SOCKET
+    emit_subcommand_info("serve", loglevel)
+    server = CountingServer(socket_path or DEFAULT_SOCKET, workers=workers)
+    _logger.info('listening on ' + server.socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        _logger.info('shutting down')
+    finally:
+        server.server_close()
+
+
+@click.command()
+@click.option('-t', '--format', 'format', required=True, help="input file format",
+              type=click.Choice(['fasta', 'fastq', 'fastqc', 'bam', 'sam']))
+@click.option('-s', '--socket', 'socket_path', help="path of the server socket", type=str, default=None)
+@add_options(bam_options)
+@add_options(shared_options)
+def client(input_file, prefix, output_dir, force, loglevel, output_format, append, format, socket_path, **bam_params):
+    """count via a running `readcounter serve`, or in-process if there is none"""
+    from .server import request_count, DEFAULT_SOCKET
+    emit_subcommand_info("client", loglevel)
+    output_file = make_output_file(input_file, prefix, output_dir, force, suffix=output_suffix(output_format, append),
+                                   append=append)
+    compress_type = guess_compress_type(input_file)
+    _logger.info('the compress type is ' + compress_type)
+    params = counter_params(format, bam_params)
+    counter = CounterDispatcher(input_file, output_file, format=format, compress_type=compress_type, **params)
+    try:
+        records = request_count(format, input_file, params, socket_path=socket_path or DEFAULT_SOCKET)
+    except OSError as e:
+        _logger.info('no readcounter server available ({err}), counting in-process'.format(err=e))
+        counter.count_read_number()
+    except RuntimeError as e:
+        raise click.ClickException('readcounter server failed: {err}'.format(err=e))
+    else:
+        counter.load_records(records)
+    write_result(counter, output_file, output_format, append)
+
+
+@click.command()
+@click.argument('input_files', type=str, nargs=-1, required=True)
+@click.option('-t', '--format', 'format', required=True, help="input file format",
+              type=click.Choice(['fasta', 'fastq', 'fastqc', 'bam', 'sam']))
+@click.option('-o', '--output_dir', help="output directory", default="./", show_default=True)
+@click.option('-f', '--force', is_flag=True, default=False, help="force to overwrite the output files")
+@click.option('-j', '--concurrency', help="maximum number of files in flight", type=int, default=64, show_default=True)
+@click.option('-w', '--workers', help="number of worker processes  [default: number of CPUs]", type=int, default=None)
+@click.option('-l', '--loglevel', default='info', type=click.Choice(['critical', 'error', 'warning', 'info', 'debug']))
+@click.option('-O', '--output_format', default='text', show_default=True,
+              help="output format, all results go to a single file unless it is text",
+              type=click.Choice(['text', 'jsonl', 'tsv', 'parquet', 'feather']))
+@click.option('-p', '--prefix', help="prefix of the single output file", type=str, default="readcounter", show_default=True)
+@click.option('-a', '--append', is_flag=True, default=False, help="append to an existing single output file")
+@add_options(bam_options)
+def batch(input_files, format, output_dir, force, concurrency, workers, loglevel, output_format, prefix, append,
+          **bam_params):
+    """count many input files concurrently, into one output file each or a single jsonl/tsv/parquet/feather file"""
+    from .scheduler import CountJob, run_batch
+    emit_subcommand_info("batch", loglevel)
+    params = counter_params(format, bam_params)
+    single_output = output_format != 'text'
+    if single_output:
+        output_file = make_output_file(prefix, prefix, output_dir, force, suffix=output_suffix(output_format, append),
+                                       append=append)
+    else:
+        output_suffix(output_format, append)
+    jobs = []
+    out_files = {}
+    for input_file in input_files:
+        out_file = None
+        if not single_output:
+            out_file = make_output_file(input_file, None, output_dir, force, suffix=".txt")
+            if out_file in out_files:
+                raise click.UsageError("{first} and {second} would be written to the same output file {out_file}".format(
+                    first=out_files[out_file], second=input_file, out_file=out_file))
+            out_files[out_file] = input_file
+        jobs.append(CountJob(input_file, format, compress_type=guess_compress_type(input_file),
+                             out_file=out_file, **params))
+    run_batch(jobs, concurrency=concurrency, workers=workers)
+    if single_output:
+        from .writers import get_writer
+        records = [record for job in jobs if job.records is not None for record in job.records]
+        get_writer(output_format, output_file, append=append).write(records)
+    failed = [job for job in jobs if job.error is not None]
+    if failed:
+        raise click.ClickException("failed to count {n} of {total} input files".format(n=len(failed), total=len(jobs)))
 
 
 @click.group()
@@ -100,6 +268,9 @@ main.add_command(fasta)
 main.add_command(fastq)
 main.add_command(fastqc)
 main.add_command(bam)
+main.add_command(batch)
+main.add_command(serve)
+main.add_command(client)
 
 
 if __name__ == "__main__":
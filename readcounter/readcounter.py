@@ -4,18 +4,15 @@
 
 
 from __future__ import print_function
+import io
 import os
 import sys
 import argparse
 import logging
-import shutil
-import tempfile
-import pysam
-import numpy as np
-import pandas as pd
-import subprocess
-from subprocess import Popen, PIPE
+import importlib
+import zipfile
 from abc import ABC, abstractmethod
+from .scanner import FormatError, count_fasta, count_fastq, filter_fastq, scan_fastq_parallel
 
 
 _logger = logging.getLogger(__name__)
@@ -34,11 +31,8 @@ class ReadCounter(ABC):
         compress_type (str): compress suffix, i.e., `zip`, `bz2`, `gz`, etc.
     """
 
-    _grep_map = {"none":"grep",
-                "gz":"zgrep",
-                "zip":"zgrep",
-                "bz2":"bzgrep"
-                }
+    # file format name reported in result records
+    format = None
 
     def __init__(self, input_file, out_file, compress_type, *args, **kwargs):
         """ To initialize a ReadCounter object
@@ -75,17 +69,27 @@ class ReadCounter(ABC):
     def write(self):
         pass
 
+    def to_records(self):
+        """Return the counting result as JSON-serializable dicts, large results are yielded one at a time."""
+        return [{"sample": self.output_filestem, "format": self.format, "numreads": int(self.read_count)}]
+
+    def load_records(self, records):
+        """Restore a counting result previously produced by `to_records`."""
+        self.read_count = records[0]["numreads"]
+
 
 class FastaReadCounter(ReadCounter):
 
+    format = "fasta"
+
     def count_read_number(self):
-        """This function implement read counting for input files in fasta format."""
+        """This function implement read counting for input files in fasta format.
+
+        Records are validated while counting, a `FormatError` with the offset of the
+        first corrupt record is raised for malformed or truncated input.
+        """
 
-        grep_prog = ReadCounter._grep_map.get(self.compress_type)
-        cmd = "{grep_prog} -c '^>' {input_file}".format(grep_prog=grep_prog, input_file=self.input_file)
-        p = subprocess.Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        read_count, err = p.communicate()
-        self.read_count = read_count.strip()
+        self.read_count = count_fasta(self.input_file, self.compress_type)
 
     def write(self):
         with open(self.out_file, 'w') as oh:
@@ -94,174 +98,120 @@ class FastaReadCounter(ReadCounter):
 
 class FastqReadCounter(ReadCounter):
 
-    def count_read_number(self):
-        """This function implement read counting for input files in fastq format."""
-
-        grep_prog = ReadCounter._grep_map.get(self.compress_type)
-        cmd = "{grep_prog} -c '^@' {input_file}".format(grep_prog=grep_prog, input_file=self.input_file)
-        p = subprocess.Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        read_count, err = p.communicate()
-        self.read_count = read_count.strip()
-
-    def write(self):
-        with open(self.out_file, 'w') as oh:
-            oh.write("{filestem} : {read_count:d}".format(filestem=self.output_filestem, read_count=int(self.read_count)) + "\n")
+    format = "fastq"
 
+    def __init__(self, input_file, out_file, compress_type="none", min_read_len=0, min_base_qual=0, workers=1):
+        super().__init__(input_file, out_file, compress_type)
+        self.min_read_len = min_read_len
+        self.min_base_qual = min_base_qual
+        self.workers = workers
+        self.raw_read_count = 0
+        self.length_histogram = None
 
-class FastqcReadCounter(ReadCounter):
+    @property
+    def filtering(self):
+        """whether read length or base quality thresholds are applied"""
+        return self.min_read_len > 0 or self.min_base_qual > 0
 
     def count_read_number(self):
-        """This function implement read counting for input files in fastqc format."""
+        """This function implement read counting for input files in fastq format.
+
+        Records are validated while counting, a `FormatError` with the offset of the
+        first corrupt record is raised for malformed or truncated input.
+        With `min_read_len` or `min_base_qual` set, `read_count` holds the number of
+        reads passing both thresholds (mean phred quality for `min_base_qual`, as for bam),
+        `raw_read_count` the number of all reads and `length_histogram` the
+        (read length, number of reads) pairs of all reads.
+        With `workers` > 1, plain files are split into byte ranges counted on that many processes.
+        """
 
-        cleanup_folder = []
-        if self.compress_type == "zip":
-            fastqc_zip = self.input_file
-            abs_path = os.path.abspath(fastqc_zip)
-            base_name = os.path.basename(abs_path).rstrip('.zip')
-            dir_name = os.path.dirname(abs_path)
-            fastqc_folder = dir_name + "/" + base_name
-            cmd = "unzip -o {fastqc_zip} -d {dir_name} && cat {fastqc_folder}/fastqc_data.txt | " \
-                  "grep '^Total Sequences'".format(fastqc_zip=fastqc_zip, dir_name=dir_name, fastqc_folder=fastqc_folder)
-            cleanup_folder.append(fastqc_folder)
+        if self.workers > 1 and self.compress_type == "none":
+            scanner = scan_fastq_parallel(self.input_file, self.workers,
+                                          min_read_len=self.min_read_len, min_base_qual=self.min_base_qual)
+            self.raw_read_count = scanner.count
+            self.read_count = scanner.passed if self.filtering else scanner.count
+            if self.filtering:
+                self.length_histogram = scanner.length_histogram
+        elif self.filtering:
+            scanner = filter_fastq(self.input_file, self.compress_type,
+                                   min_read_len=self.min_read_len, min_base_qual=self.min_base_qual)
+            self.raw_read_count = scanner.count
+            self.read_count = scanner.passed
+            self.length_histogram = scanner.length_histogram
         else:
-            fastqc_folder = self.input_file
-            cmd = "cat {fastqc_folder}/fastqc_data.txt | grep '^Total Sequences'".format(fastqc_folder=fastqc_folder)
-        line = subprocess.check_output(cmd, shell=True)
-        read_count = line.strip().split()[-1]
-        for folder in cleanup_folder:
-            try:
-                shutil.rmtree(folder, ignore_errors=False)
-            except Exception as e:
-                _logger.warning(e)
-        self.read_count = read_count
+            self.read_count = self.raw_read_count = count_fastq(self.input_file, self.compress_type)
 
     def write(self):
         with open(self.out_file, 'w') as oh:
             oh.write("{filestem} : {read_count:d}".format(filestem=self.output_filestem, read_count=int(self.read_count)) + "\n")
+            if self.filtering:
+                oh.write("raw_reads : {raw:d}\n".format(raw=self.raw_read_count))
+                oh.write("length_histogram : {hist}\n".format(
+                    hist=",".join("{0}:{1}".format(length, n) for length, n in self.length_histogram)))
+
+    def to_records(self):
+        records = super().to_records()
+        if self.filtering:
+            records[0]["raw_reads"] = self.raw_read_count
+            records[0]["length_histogram"] = [list(pair) for pair in self.length_histogram]
+        return records
+
+    def load_records(self, records):
+        super().load_records(records)
+        self.raw_read_count = records[0].get("raw_reads", self.read_count)
+        if "length_histogram" in records[0]:
+            self.length_histogram = [tuple(pair) for pair in records[0]["length_histogram"]]
+
+
+def _total_sequences(lines):
+    """ return the `Total Sequences` value of a fastqc_data.txt report """
+    offset = 0
+    for line in lines:
+        if line.startswith("Total Sequences"):
+            return int(line.split()[-1])
+        offset += len(line)
+    raise FormatError("no 'Total Sequences' line in fastqc_data.txt", offset)
 
 
-class BamReadCounter(ReadCounter):
+class FastqcReadCounter(ReadCounter):
 
-    def __init__(self, input_file, out_file, compress_type="none", min_read_len=0, min_aln_len=0, min_map_qual=0, min_base_qual=0, use_bamcov=False, pysam_mem='10G'):
-        try:
-            super().__init__(input_file, out_file, compress_type)
-        except Exception as e:
-            _logger.warning("Python3 is not supported by your interpreter: {err_msg}, using Python2 instead".format(err_msg=e))
-            super(BamReadCounter, self).__init__(input_file, out_file, compress_type)
-        self.min_read_len = min_read_len
-        self.min_aln_len = min_aln_len
-        self.min_map_qual = min_map_qual
-        self.min_base_qual = min_base_qual
-        self.use_bamcov = use_bamcov
-
-    def _get_depth_per_bam_file_via_bamcov(self):
-
-        # create tmp dir and file to save bamcov result
-        input_basename = os.path.basename(self.input_file)
-        input_filestem = os.path.splitext(input_basename)[0]
-        tmp_bamcov_dir = tempfile.mkdtemp()
-        tmp_bamcov_file = os.path.join(tmp_bamcov_dir, input_filestem+"_bamcov.tsv")
-
-        if not os.path.exists(self.input_file + ".bai"):
-            _logger.info("indexing input bam file")
-            pysam.index(self.input_file)
-
-        _logger.info("min_read_len is: "+ str(self.min_read_len))
-        # command for bamcov
-        cmd = ['bamcov', '--output', tmp_bamcov_file,
-               '--min-read-len', str(self.min_read_len),
-               '--min-MQ', str(self.min_map_qual),
-               '--min-BQ', str(self.min_base_qual),
-               self.input_file]
-        _logger.info("counting mapped reads using bamcov")
-        _logger.info("[bamcov commandline] {c}".format(c=" ".join(cmd)))
-        try:
-            p = subprocess.Popen(cmd, shell=False, stdout=PIPE, stderr=PIPE)
-            output, err = p.communicate()
-        except Exception as e:
-            _logger.warning("It seems like your bam file is not sorted, trying to sort it and run bamcov again ...")
-            try:
-                tmp_file = tempfile.mkstemp()[1]
-                _logger.debug(tmp_file)
-                pysam.sort("-o", tmp_file, self.input_file)
-                shutil.move(tmp_file, self.input_file)
-                pysam.index(self.input_file)
-                ret_code = subprocess.check_call(cmd, shell=False)
-            except Exception as e:
-                raise Exception("failed to call bamcov, try to debug in terminal with this command {cmd}".format(cmd=" ".join(cmd)))
-
-        # return bamcov df
-        df = pd.read_csv(tmp_bamcov_file, sep='\t')
-        shutil.rmtree(tmp_bamcov_dir, ignore_errors=True)
-        return df
-
-    def _get_depth_per_bam_file(self):
-        """ get read count for each contig"""
-
-        def filter_read(aln):
-            # possible filters
-            # aln.is_paired=True
-            # np.mean(aln.query_alignment_qualities[1])=30
-            if ((not aln.is_unmapped) and (not aln.is_duplicate) and (not aln.is_qcfail) and 
-                (not aln.is_secondary) and 
-                (not aln.is_supplementary) and 
-                (aln.query_length >= self.min_read_len) and 
-                (aln.mapping_quality >= self.min_map_qual) and 
-                (np.mean(aln.query_qualities[1]) >= self.min_base_qual) and 
-                (aln.query_alignment_length >= self.min_aln_len)):
-                return True
-            else:
-                return False
-
-        # create tmp dir and file to save bamcov result
-        input_basename = os.path.basename(self.input_file)
-        input_filestem = os.path.splitext(input_basename)[0]
-  
-        if not os.path.exists(self.input_file + ".bai"):
-            _logger.info("indexing input bam file")
-            pysam.index(self.input_file)
-
-        samfile = pysam.AlignmentFile(self.input_file, "rb") 
-        df = pd.DataFrame(samfile.header['SQ'])
-        df['start'] = [0]*len(df.index)
-        df['numreads'] = 0*len(df.index)
-        df.columns = ['endpos', '#rname', 'start', 'numreads']
-
-        _logger.info("counting mapped reads using pysam")
-        for i in df.index: 
-            stop, contig, start, numreads = df.loc[i,] 
-            count = samfile.count(contig=contig, start=start, stop=stop, region=None, until_eof=False, read_callback=filter_read)
-            df.loc[i, 'numreads'] = count 
-        
-        return df
+    format = "fastqc"
 
     def count_read_number(self):
-        """This function implement read counting for input files in bam format."""
-        if self.use_bamcov:
-            try: 
-                df = self._get_depth_per_bam_file_via_bamcov()
-            except Exception as e:
-                _logger.error("it seems bamcov doesn't work for you, use pysam instead")
-                df = self._get_depth_per_bam_file()
+        """This function implement read counting for input files in fastqc format.
+
+        The `Total Sequences` line of `fastqc_data.txt` is read directly from the fastqc
+        folder or zip archive, nothing is extracted to disk.
+        """
+
+        if self.compress_type == "zip":
+            with zipfile.ZipFile(self.input_file) as archive:
+                members = [name for name in archive.namelist() if name.rsplit("/", 1)[-1] == "fastqc_data.txt"]
+                if not members:
+                    raise FormatError("no fastqc_data.txt in fastqc archive", 0)
+                # the report at the top of the archive, not one of a nested folder
+                with archive.open(min(members, key=len)) as fh:
+                    self.read_count = _total_sequences(io.TextIOWrapper(fh, encoding="utf-8"))
         else:
-            df = self._get_depth_per_bam_file()
-        selected_df = df[['#rname', 'endpos', 'numreads']] #, 'covbases', 'coverage', 'meandepth']]
-        selected_df.columns = ['contig', 'length', 'numreads']
-        selected_df = selected_df[selected_df['numreads'] != 0]
-        self.read_count = selected_df
+            with open(os.path.join(self.input_file, "fastqc_data.txt"), encoding="utf-8") as fh:
+                self.read_count = _total_sequences(fh)
 
     def write(self):
-        self.read_count.to_csv(path_or_buf=self.out_file, sep='\t', header=True, index=False)
+        with open(self.out_file, 'w') as oh:
+            oh.write("{filestem} : {read_count:d}".format(filestem=self.output_filestem, read_count=int(self.read_count)) + "\n")
 
 
 class CounterDispatcher(ReadCounter):
     """dispatch read counting jobs"""
 
-    counter_map = {"fasta": FastaReadCounter,
-                   "fastq": FastqReadCounter,
-                   "fastqc": FastqcReadCounter,
-                   "bam": BamReadCounter, 
-                   "sam": BamReadCounter
+    # counters are registered by import path and only resolved on first use,
+    # so that formats with heavy dependencies (pysam, pandas) do not slow
+    # down the startup of the others
+    counter_map = {"fasta": "readcounter.readcounter.FastaReadCounter",
+                   "fastq": "readcounter.readcounter.FastqReadCounter",
+                   "fastqc": "readcounter.readcounter.FastqcReadCounter",
+                   "bam": "readcounter.bam.BamReadCounter",
+                   "sam": "readcounter.bam.BamReadCounter"
                    }
 
     def __init__(self, input_file, out_file, format, compress_type, *args, **kwargs):
@@ -272,11 +222,36 @@ class CounterDispatcher(ReadCounter):
             super(CounterDispatcher, self).__init__(input_file, out_file, compress_type, *args, **kwargs)
         self.format = format
         # get corresponding Counter class, and initialize a readcounter object
-        _Counter = CounterDispatcher.counter_map.get(self.format, None)
+        _Counter = CounterDispatcher.get_counter(self.format)
         self.counter = _Counter(self.input_file, self.out_file, self.compress_type, *args, **kwargs)
 
+    @classmethod
+    def get_counter(cls, format):
+        """Resolve the Counter class registered for `format`.
+
+        Args:
+            format (str): input file format, a key of `counter_map`
+
+        Returns:
+            the ReadCounter subclass, imported on first use
+        """
+        _Counter = cls.counter_map.get(format, None)
+        if _Counter is None:
+            raise ValueError("unsupported input format: {format}".format(format=format))
+        if isinstance(_Counter, str):
+            module_name, class_name = _Counter.rsplit(".", 1)
+            _Counter = getattr(importlib.import_module(module_name), class_name)
+            cls.counter_map[format] = _Counter
+        return _Counter
+
     def count_read_number(self):
         self.counter.count_read_number()
 
     def write(self):
-        self.counter.write()
\ No newline at end of file
+        self.counter.write()
+
+    def to_records(self):
+        return self.counter.to_records()
+
+    def load_records(self, records):
+        self.counter.load_records(records)
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+
+"""Validating block scanners for fasta and fastq streams.
+
+The input is read in large blocks and split into lines once. Fastq records are
+validated in the same pass that counts them: for blocks of well-formed 4-line
+records the header/separator/length checks run on whole line slices, and the
+scanner falls back to a line-by-line state machine for multi-line records and
+to locate the first corrupt record.
+"""
+
+
+import os
+import bz2
+import gzip
+import mmap
+import zlib
+import zipfile
+import logging
+from operator import methodcaller
+
+
+_logger = logging.getLogger(__name__)
+
+
+BLOCK_SIZE = 4 << 20
+# smallest byte range of a plain fastq file worth a worker process of its own
+MIN_RANGE_SIZE = 16 << 20
+# how far past a split point a record boundary is searched for
+SYNC_WINDOW = 1 << 20
+
+
+class FormatError(ValueError):
+    """Raised when an input stream is truncated or does not follow its format.
+
+    Attributes:
+        offset (int): byte offset of the first corrupt record in the decompressed stream
+    """
+
+    def __init__(self, message, offset):
+        super().__init__("{message} at byte offset {offset}".format(message=message, offset=offset))
+        self.message = message
+        self.offset = offset
+
+    def __reduce__(self):
+        # raised in worker processes, keep both arguments when pickled
+        return FormatError, (self.message, self.offset)
+
+
+def open_input(input_file, compress_type="none"):
+    """Open `input_file` for binary reading, decompressing it on the fly.
+
+    Args:
+        input_file (str): input file
+        compress_type (str): one of `none`, `gz`, `bz2` or `zip`
+
+    Returns:
+        a binary file object
+    """
+    if compress_type == "gz":
+        return gzip.open(input_file, "rb")
+    if compress_type == "bz2":
+        return bz2.open(input_file, "rb")
+    if compress_type == "zip":
+        try:
+            archive = zipfile.ZipFile(input_file)
+        except (zipfile.BadZipFile, OSError) as e:
+            raise FormatError("truncated or corrupt zip archive ({err})".format(err=e), 0)
+        try:
+            members = [info for info in archive.infolist() if not info.is_dir()]
+            if not members:
+                raise FormatError("empty zip archive", 0)
+            # the archive is closed together with the member handle
+            return archive.open(members[0])
+        except (zipfile.BadZipFile, OSError) as e:
+            raise FormatError("truncated or corrupt zip archive ({err})".format(err=e), 0)
+        finally:
+            archive.close()
+    return open(input_file, "rb")
+
+
+def iter_blocks(handle, block_size=BLOCK_SIZE):
+    """Yield blocks of `handle`, turning decompression errors into `FormatError`."""
+    offset = 0
+    while True:
+        try:
+            block = handle.read(block_size)
+        except (EOFError, OSError, zlib.error, zipfile.BadZipFile) as e:
+            raise FormatError("truncated or corrupt compressed stream ({err})".format(err=e), offset)
+        if not block:
+            return
+        offset += len(block)
+        yield block
+
+
+_is_header = methodcaller("startswith", b"@")
+_is_separator = methodcaller("startswith", b"+")
+
+_HEADER, _SEQUENCE, _QUALITY = 0, 1, 2
+
+
+class FastqScanner(object):
+    """Count and validate fastq records fed as consecutive blocks.
+
+    Multi-line records are supported, Windows line endings are tolerated, and
+    quality lines starting with `@` are never mistaken for headers.
+
+    Attributes:
+        count (int): number of complete records seen so far
+        offset (int): byte offset of the next unconsumed line
+    """
+
+    # whether complete quality strings are passed to `_add_qualities`
+    collect_qualities = False
+
+    def __init__(self):
+        self.count = 0
+        self.offset = 0
+        self._carry = b""
+        self._qual_parts = []
+        self._state = _HEADER
+        self._record_offset = 0
+        self._seq_len = 0
+        self._qual_len = 0
+
+    def feed(self, block):
+        lines = (self._carry + block).split(b"\n") if self._carry else block.split(b"\n")
+        self._carry = lines.pop()
+        self._scan(lines)
+
+    def finish(self):
+        """Flush the last line and check that the stream ended on a record boundary.
+
+        Returns:
+            the number of records
+        """
+        if self._carry:
+            self._scan([self._carry])
+            self._carry = b""
+        if self._state != _HEADER:
+            raise FormatError("truncated fastq record", self._record_offset)
+        return self.count
+
+    def merge(self, other):
+        """Add the counts of `other`, a scanner of the records following those of this one."""
+        self.count += other.count
+
+    def _scan(self, lines):
+        n = len(lines)
+        i = 0
+        fast = True
+        while i < n:
+            if fast and self._state == _HEADER:
+                j = self._scan_fast(lines, i)
+                fast = j > i or n - i < 4
+                i = j
+            if i < n:
+                i = self._scan_slow(lines, i, stop_on_record=fast)
+
+    def _scan_fast(self, lines, i):
+        """Consume all complete 4-line records from `i` if they are all well-formed."""
+        end = i + (len(lines) - i) // 4 * 4
+        if end == i:
+            return i
+        if (all(map(_is_header, lines[i:end:4])) and
+                all(map(_is_separator, lines[i + 2:end:4])) and
+                list(map(len, lines[i + 1:end:4])) == list(map(len, lines[i + 3:end:4]))):
+            self.count += (end - i) // 4
+            self.offset += sum(map(len, lines[i:end])) + (end - i)
+            if self.collect_qualities:
+                self._add_qualities(lines[i + 3:end:4])
+            return end
+        return i
+
+    def _add_qualities(self, qualities):
+        """Hook called with the quality strings of complete records."""
+        pass
+
+    def _scan_slow(self, lines, i, stop_on_record=False):
+        """Run the record state machine from `i`, up to the end of a record if `stop_on_record`."""
+        state = self._state
+        seq_len = self._seq_len
+        qual_len = self._qual_len
+        offset = self.offset
+        n = len(lines)
+        while i < n:
+            line = lines[i]
+            length = len(line)
+            if line[-1:] == b"\r":
+                line = line[:-1]
+            if state == _HEADER:
+                if line[:1] == b"@":
+                    self._record_offset = offset
+                    seq_len = 0
+                    state = _SEQUENCE
+                elif line.strip():
+                    raise FormatError("expected '@' at the start of a fastq record", offset)
+            elif state == _SEQUENCE:
+                if line[:1] == b"+":
+                    qual_len = 0
+                    del self._qual_parts[:]
+                    state = _QUALITY
+                else:
+                    seq_len += len(line)
+            else:
+                qual_len += len(line)
+                if qual_len > seq_len:
+                    raise FormatError("quality longer than sequence in fastq record", self._record_offset)
+                if self.collect_qualities:
+                    self._qual_parts.append(line)
+                if qual_len == seq_len:
+                    self.count += 1
+                    state = _HEADER
+                    if self.collect_qualities:
+                        self._add_qualities([b"".join(self._qual_parts)])
+            offset += length + 1
+            i += 1
+            if stop_on_record and state == _HEADER:
+                break
+        self._state = state
+        self._seq_len = seq_len
+        self._qual_len = qual_len
+        self.offset = offset
+        return i
+
+
+class FilteringFastqScanner(FastqScanner):
+    """Count fastq records passing read length and mean base quality thresholds.
+
+    Quality strings are buffered and evaluated in batches with NumPy, and a
+    histogram of the read lengths of all records is kept.
+
+    Attributes:
+        count (int): number of complete records seen so far
+        passed (int): number of records passing both thresholds
+        length_counts (numpy.ndarray): number of records per read length
+    """
+
+    collect_qualities = True
+    batch_size = 1 << 16
+
+    def __init__(self, min_read_len=0, min_base_qual=0, phred_offset=33):
+        import numpy as np
+
+        super().__init__()
+        self.min_read_len = min_read_len
+        self.min_base_qual = min_base_qual
+        self.phred_offset = phred_offset
+        self.passed = 0
+        self.length_counts = np.zeros(0, dtype=np.int64)
+        self._pending = []
+
+    def _add_qualities(self, qualities):
+        self._pending.extend(qualities)
+        if len(self._pending) >= self.batch_size:
+            self._evaluate()
+
+    def _evaluate(self):
+        import numpy as np
+
+        qualities = self._pending
+        self._pending = []
+        if not qualities:
+            return
+        joined = b"".join(qualities)
+        if b"\r" in joined:
+            qualities = [q[:-1] if q[-1:] == b"\r" else q for q in qualities]
+            joined = b"".join(qualities)
+        lengths = np.fromiter(map(len, qualities), dtype=np.int64, count=len(qualities))
+        mean_quals = np.zeros(len(lengths))
+        nonempty = lengths > 0
+        if joined:
+            # empty quality strings would break reduceat, sum the others only
+            starts = (np.cumsum(lengths) - lengths)[nonempty]
+            sums = np.add.reduceat(np.frombuffer(joined, dtype=np.uint8), starts, dtype=np.int64)
+            mean_quals[nonempty] = sums / lengths[nonempty] - self.phred_offset
+        passing = (lengths >= self.min_read_len) & (mean_quals >= self.min_base_qual)
+        self.passed += int(np.count_nonzero(passing))
+        self._add_length_counts(np.bincount(lengths))
+
+    def _add_length_counts(self, counts):
+        if len(counts) > len(self.length_counts):
+            counts = counts.copy()
+            counts[:len(self.length_counts)] += self.length_counts
+            self.length_counts = counts
+        else:
+            self.length_counts[:len(counts)] += counts
+
+    def merge(self, other):
+        super().merge(other)
+        self.passed += other.passed
+        self._add_length_counts(other.length_counts)
+
+    def finish(self):
+        count = super().finish()
+        self._evaluate()
+        return count
+
+    @property
+    def length_histogram(self):
+        """list of (read length, number of records) pairs for the observed lengths"""
+        return [(int(length), int(self.length_counts[length])) for length in self.length_counts.nonzero()[0]]
+
+
+class FastaScanner(object):
+    """Count and validate fasta records fed as consecutive blocks.
+
+    Attributes:
+        count (int): number of records seen so far
+        offset (int): number of bytes seen so far
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.offset = 0
+        self._started = False
+        self._last = b"\n"
+
+    def feed(self, block):
+        if not self._started:
+            stripped = block.lstrip()
+            if stripped:
+                if stripped[:1] != b">":
+                    raise FormatError("expected '>' at the start of a fasta record",
+                                      self.offset + len(block) - len(stripped))
+                self._started = True
+        self.count += block.count(b"\n>")
+        if self._last == b"\n" and block[:1] == b">":
+            self.count += 1
+        self._last = block[-1:]
+        self.offset += len(block)
+
+    def finish(self):
+        """Returns:
+            the number of records
+        """
+        return self.count
+
+
+def _scan(scanner, input_file, compress_type, block_size):
+    with open_input(input_file, compress_type) as handle:
+        for block in iter_blocks(handle, block_size):
+            scanner.feed(block)
+    return scanner.finish()
+
+
+def count_fastq(input_file, compress_type="none", block_size=BLOCK_SIZE):
+    """Count the records of a fastq file, validating them on the way.
+
+    Raises:
+        FormatError: at the first corrupt record or if the stream is truncated
+    """
+    return _scan(FastqScanner(), input_file, compress_type, block_size)
+
+
+def filter_fastq(input_file, compress_type="none", min_read_len=0, min_base_qual=0, block_size=BLOCK_SIZE):
+    """Count the records of a fastq file passing read length and mean base quality thresholds.
+
+    Returns:
+        the `FilteringFastqScanner` holding raw and passing counts and the read length histogram
+
+    Raises:
+        FormatError: at the first corrupt record or if the stream is truncated
+    """
+    scanner = FilteringFastqScanner(min_read_len=min_read_len, min_base_qual=min_base_qual)
+    _scan(scanner, input_file, compress_type, block_size)
+    return scanner
+
+
+def _is_record_start(buf, start):
+    """Check whether a well-formed 4-line fastq record starts at `start` of `buf`.
+
+    The record must be followed by the end of `buf` or another `@` line, so that a
+    quality line starting with `@` is never taken for a header: the line after it
+    would be a sequence line where the `+` separator is expected.
+    """
+    size = len(buf)
+    lines = []
+    pos = start
+    while pos < size and len(lines) < 5:
+        end = buf.find(b"\n", pos)
+        if end < 0:
+            end = size
+        line = buf[pos:end]
+        lines.append(line[:-1] if line[-1:] == b"\r" else line)
+        pos = end + 1
+    if len(lines) < 4:
+        return False
+    header, sequence, separator, quality = lines[:4]
+    return (header[:1] == b"@" and separator[:1] == b"+" and len(sequence) == len(quality) and
+            (len(lines) == 4 or lines[4][:1] == b"@"))
+
+
+def find_record_start(buf, pos, window=SYNC_WINDOW):
+    """Return the offset of the first fastq record starting in `pos` to `pos + window` of `buf`, or -1.
+
+    Only 4-line records are recognized, multi-line records cannot be synchronized on.
+    """
+    limit = min(len(buf), pos + window)
+    search = max(pos - 1, 0)
+    while True:
+        hit = buf.find(b"\n@", search, limit)
+        if hit < 0:
+            return -1
+        if _is_record_start(buf, hit + 1):
+            return hit + 1
+        search = hit + 1
+
+
+def split_fastq(input_file, parts, min_range_size=None):
+    """Split a plain fastq file into up to `parts` byte ranges starting on record boundaries.
+
+    Ranges are at least `min_range_size` bytes, `MIN_RANGE_SIZE` if None.
+
+    Returns:
+        list of (start, end) byte ranges, or None if no record boundary was found near a split point
+    """
+    if min_range_size is None:
+        min_range_size = MIN_RANGE_SIZE
+    size = os.path.getsize(input_file)
+    parts = max(1, min(parts, size // max(min_range_size, 1)))
+    if parts == 1:
+        return [(0, size)]
+    starts = [0]
+    with open(input_file, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for i in range(1, parts):
+            start = find_record_start(buf, size * i // parts)
+            if start < 0:
+                return None
+            if start > starts[-1]:
+                starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def _scan_range(input_file, start, end, scanner, block_size=BLOCK_SIZE):
+    """Scan the records in bytes `start` to `end` of a plain file, executed in a worker process."""
+    scanner.offset = start
+    with open(input_file, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for pos in range(start, end, block_size):
+            scanner.feed(buf[pos:min(pos + block_size, end)])
+    scanner.finish()
+    return scanner
+
+
+def scan_fastq_parallel(input_file, workers, min_read_len=0, min_base_qual=0, min_range_size=None):
+    """Count the records of a plain fastq file on `workers` processes, one byte range each.
+
+    Ranges start on record boundaries and are read through memory maps, the scanners of
+    all ranges are merged. The file is scanned serially if it is too small to be split,
+    or if no record boundary is found near a split point, e.g., for multi-line records.
+
+    Returns:
+        the merged scanner, a `FilteringFastqScanner` if a threshold is set, else a `FastqScanner`
+
+    Raises:
+        FormatError: at the first corrupt record or if the file is truncated
+    """
+    filtering = min_read_len > 0 or min_base_qual > 0
+
+    def make_scanner():
+        if filtering:
+            return FilteringFastqScanner(min_read_len=min_read_len, min_base_qual=min_base_qual)
+        return FastqScanner()
+
+    ranges = split_fastq(input_file, workers, min_range_size)
+    if ranges is None:
+        _logger.warning("no fastq record boundary found near a split point of {input_file}, "
+                        "counting it serially".format(input_file=input_file))
+    if not ranges or len(ranges) == 1:
+        scanner = make_scanner()
+        _scan(scanner, input_file, "none", BLOCK_SIZE)
+        return scanner
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    starts, ends = zip(*ranges)
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=multiprocessing.get_context("forkserver")) as pool:
+        scanners = list(pool.map(_scan_range, [input_file] * len(ranges), starts, ends,
+                                 [make_scanner() for _ in ranges]))
+    scanner = scanners[0]
+    for other in scanners[1:]:
+        scanner.merge(other)
+    return scanner
+
+
+def count_fasta(input_file, compress_type="none", block_size=BLOCK_SIZE):
+    """Count the records of a fasta file, validating them on the way.
+
+    Raises:
+        FormatError: if the file does not start with a fasta record or if the stream is truncated
+    """
+    return _scan(FastaScanner(), input_file, compress_type, block_size)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Concurrent batch counting of many input files.
+
+On network storage (NFS, Lustre) counting thousands of small files is dominated
+by the latency of stat/open/read calls rather than by CPU. The scheduler below
+overlaps these calls with bounded concurrency on an asyncio event loop, runs
+the counting of small plain files on I/O threads, and hands CPU-heavy jobs
+(decompression, BAM decoding) to a process pool. Jobs are started largest
+first to avoid a long tail at the end of the batch.
+"""
+
+
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .readcounter import CounterDispatcher
+
+
+_logger = logging.getLogger(__name__)
+
+
+class CountJob(object):
+    """A single counting job of a batch.
+
+    Attributes:
+        input_file (str): input file for read counting
+        format (str): input file format
+        compress_type (str): type of compression
+        out_file (str): output file, None to skip writing
+        params (dict): extra keyword arguments for the Counter class
+        size (int): input size in bytes, filled in by the scheduler
+        records (list): counting result, see `ReadCounter.to_records`
+        error (Exception): the exception raised by a failed job, or None
+    """
+
+    def __init__(self, input_file, format, compress_type="none", out_file=None, **params):
+        self.input_file = input_file
+        self.format = format
+        self.compress_type = compress_type
+        self.out_file = out_file
+        self.params = params
+        self.size = None
+        self.records = None
+        self.error = None
+
+    @property
+    def cpu_bound(self):
+        """whether counting needs decompression or BAM decoding"""
+        return self.compress_type != "none" or self.format in ("bam", "sam")
+
+    def __repr__(self):
+        return "CountJob({input_file!r}, {format!r})".format(input_file=self.input_file, format=self.format)
+
+
+def _input_size(job):
+    """Size of the data that will be read for `job`."""
+    if job.format == "fastqc" and os.path.isdir(job.input_file):
+        return os.stat(os.path.join(job.input_file, "fastqc_data.txt")).st_size
+    return os.stat(job.input_file).st_size
+
+
+def _run_job(input_file, format, compress_type, out_file, params):
+    """Count reads of a single input file, executed in an executor."""
+    counter = CounterDispatcher(input_file, out_file, format=format, compress_type=compress_type, **params)
+    counter.count_read_number()
+    if out_file is not None:
+        counter.write()
+    return list(counter.to_records())
+
+
+async def count_files_async(jobs, concurrency=64, io_executor=None, cpu_executor=None, small_file_size=1 << 20):
+    """Count reads of all `jobs` concurrently.
+
+    Args:
+        jobs (list): `CountJob` objects, updated in place
+        concurrency (int): maximum number of jobs in flight
+        io_executor (Executor): executor for stat calls and small plain files
+        cpu_executor (Executor): executor for compressed, large or BAM inputs
+        small_file_size (int): plain inputs up to this size are counted on `io_executor`
+
+    Returns:
+        the jobs, in the order they were started
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def stat(job):
+        async with semaphore:
+            try:
+                job.size = await loop.run_in_executor(io_executor, _input_size, job)
+            except OSError as e:
+                _logger.error("failed to stat {input_file}: {err}".format(input_file=job.input_file, err=e))
+                job.size = -1
+                job.error = e
+
+    await asyncio.gather(*[stat(job) for job in jobs])
+    ordered = sorted(jobs, key=lambda job: job.size, reverse=True)
+
+    async def run(job):
+        async with semaphore:
+            executor = cpu_executor if (job.cpu_bound or job.size > small_file_size) else io_executor
+            try:
+                job.records = await loop.run_in_executor(executor, _run_job, job.input_file, job.format,
+                                                         job.compress_type, job.out_file, job.params)
+            except Exception as e:
+                _logger.error("failed to count {input_file}: {err}".format(input_file=job.input_file, err=e))
+                job.error = e
+
+    await asyncio.gather(*[run(job) for job in ordered if job.error is None])
+    return ordered
+
+
+def run_batch(jobs, concurrency=64, workers=None, small_file_size=1 << 20):
+    """Synchronous entry point of `count_files_async`.
+
+    Args:
+        jobs (list): `CountJob` objects, updated in place
+        concurrency (int): maximum number of jobs in flight, also the number of I/O threads
+        workers (int): number of worker processes for CPU-heavy jobs, defaults to the number of CPUs
+        small_file_size (int): plain inputs up to this size are counted on I/O threads
+
+    Returns:
+        the jobs, in the order they were started
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        # forkserver: the I/O threads run subprocesses, a worker forked while one of
+        # them holds open pipes would keep the pipes from ever reaching EOF
+        with ThreadPoolExecutor(max_workers=concurrency) as io_executor, \
+                ProcessPoolExecutor(max_workers=workers,
+                                    mp_context=multiprocessing.get_context("forkserver")) as cpu_executor:
+            return loop.run_until_complete(count_files_async(jobs, concurrency=concurrency,
+                                                             io_executor=io_executor,
+                                                             cpu_executor=cpu_executor,
+                                                             small_file_size=small_file_size))
+    finally:
+        loop.close()
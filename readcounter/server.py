@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""Long-running counting server and its client.
+
+The server keeps a pool of warm worker processes behind a Unix-domain socket,
+so that workflow engines launching many small counting tasks do not pay the
+interpreter and import startup for each of them. The protocol is line based:
+each request is a JSON object on a single line, e.g.,
+
+    {"format": "fastq", "path": "/data/sample.fq.gz", "params": {}}
+
+and is answered by a single JSON line, either
+
+    {"status": "ok", "records": [{"sample": "sample", "numreads": 250}]}
+
+or
+
+    {"status": "error", "message": "..."}
+"""
+
+
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from .readcounter import CounterDispatcher
+from .utils import guess_compress_type
+
+
+_logger = logging.getLogger(__name__)
+
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "readcounter-{uid}.sock".format(uid=os.getuid()))
+
+
+def _init_worker():
+    """Warm up a worker process: import heavy dependencies and enable the BAM handle cache."""
+    try:
+        from .bam import BamReadCounter
+    except ImportError:
+        return
+    BamReadCounter.samfile_cache = OrderedDict()
+
+
+def _noop():
+    pass
+
+
+def _count_in_worker(format, path, params):
+    """Count reads of a single input file, executed in a worker process."""
+    params = dict(params)
+    compress_type = params.pop("compress_type", None) or guess_compress_type(path)
+    counter = CounterDispatcher(path, None, format=format, compress_type=compress_type, **params)
+    counter.count_read_number()
+    return list(counter.to_records())
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode("utf-8"))
+                records = self.server.count(request["format"], request["path"], request.get("params", {}))
+                response = {"status": "ok", "records": records}
+            except Exception as e:
+                _logger.warning("failed to process request {req}: {err}".format(req=line.strip(), err=e))
+                response = {"status": "error", "message": str(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class CountingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve counting requests on a Unix-domain socket.
+
+    Requests are dispatched to `CounterDispatcher` on a pool of worker processes.
+    Results are cached by input file identity (path, size and mtime) and parameters,
+    and worker processes keep their opened BAM files, and thus indexes, across requests.
+
+    Attributes:
+        socket_path (str): path of the Unix-domain socket to listen on.
+        workers (int): number of worker processes, defaults to the number of CPUs.
+        max_cache (int): maximum number of cached results.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, workers=None, max_cache=4096):
+        if os.path.exists(socket_path):
+            if is_server_running(socket_path):
+                raise OSError("a readcounter server is already listening on {path}".format(path=socket_path))
+            _logger.info("removing stale socket {path}".format(path=socket_path))
+            os.unlink(socket_path)
+        self.socket_path = socket_path
+        self.max_cache = max_cache
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # forkserver: workers must not be forked from a process running handler threads
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                        mp_context=multiprocessing.get_context("forkserver"))
+        # start all workers now, so that the first requests do not pay for their startup
+        wait([self.pool.submit(_noop) for _ in range(self.workers)])
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def _cache_key(self, format, path, params):
+        stat = os.stat(path)
+        key = (format, os.path.realpath(path), stat.st_size, stat.st_mtime_ns, json.dumps(params, sort_keys=True))
+        if params.get("regions", None):
+            # counts per region change with the BED file as well
+            regions_stat = os.stat(params["regions"])
+            key += (regions_stat.st_size, regions_stat.st_mtime_ns)
+        return key
+
+    def count(self, format, path, params):
+        """Count reads of `path`, reusing the cached result if the file did not change."""
+        if not (os.path.isfile(path) or os.path.isdir(path)):
+            raise ValueError("input is not an existing file or directory: {path}".format(path=path))
+        key = self._cache_key(format, path, params)
+        with self._cache_lock:
+            future = self._cache.get(key, None)
+            if future is None:
+                future = self.pool.submit(_count_in_worker, format, path, params)
+                self._cache[key] = future
+                while len(self._cache) > self.max_cache:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+        try:
+            return future.result()
+        except Exception:
+            # do not cache failures, the input may be fixed later
+            with self._cache_lock:
+                if self._cache.get(key, None) is future:
+                    del self._cache[key]
+            raise
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+def is_server_running(socket_path=DEFAULT_SOCKET):
+    """Check whether a server accepts connections on `socket_path`."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def request_count(format, path, params=None, socket_path=DEFAULT_SOCKET, timeout=None):
+    """Ask a running server to count reads of `path`.
+
+    Args:
+        format (str): input file format
+        path (str): input file, made absolute before sending
+        params (dict): extra keyword arguments for the Counter class, a `regions` BED file is made absolute too
+        socket_path (str): path of the server socket
+        timeout (float): socket timeout in seconds, None to wait forever
+
+    Returns:
+        list of result records, see `ReadCounter.to_records`
+
+    Raises:
+        OSError: if no server is listening on `socket_path`
+        RuntimeError: if the server failed to count the input file or sent a malformed reply
+    """
+    params = dict(params or {})
+    if params.get("regions", None):
+        # the server resolves relative paths against its own working directory
+        params["regions"] = os.path.abspath(params["regions"])
+    request = {"format": format, "path": os.path.abspath(path), "params": params}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as fh:
+            line = fh.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise ConnectionError("readcounter server closed the connection without answering")
+    try:
+        response = json.loads(line.decode("utf-8"))
+        status = response["status"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise RuntimeError("malformed reply from readcounter server: {err}".format(err=e))
+    if status != "ok":
+        raise RuntimeError(response.get("message", "unknown server error"))
+    return response["records"]
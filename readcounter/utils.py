@@ -19,8 +19,8 @@ def add_options(options):
     return _add_options
 
 
-def make_output_file(input_file, prefix=None, output_dir="./", force=False, suffix=".txt"):
-    """make output_file, check existence"""
+def make_output_file(input_file, prefix=None, output_dir="./", force=False, suffix=".txt", append=False):
+    """make output_file, check existence unless results are appended to it"""
 
     # input and output handeling
     if not os.path.exists(output_dir):
@@ -39,7 +39,9 @@ def make_output_file(input_file, prefix=None, output_dir="./", force=False, suff
     out_file = os.path.join(output_dir, prefix + suffix)
     _logger.info("output file is {}".format(out_file))
     if os.path.exists(out_file):
-        if force:
+        if append:
+            _logger.info("output file exists, results will be appended")
+        elif force:
             _logger.warning("output file exists, will be overwritten!")
         else:
             err_msg = "output file detected, please backup it at first!\n\n"
@@ -65,6 +67,54 @@ def guess_compress_type(input_file):
     return compress_type
 
 
+def guess_format(input_file):
+    """ guess input format from the file name, a directory is taken as a fastqc folder """
+
+    format_map = {"fa": "fasta", "fas": "fasta", "fna": "fasta", "fasta": "fasta",
+                  "fq": "fastq", "fastq": "fastq",
+                  "bam": "bam", "sam": "sam"}
+
+    basename = os.path.basename(os.path.normpath(input_file))
+    if os.path.isdir(input_file) or basename.endswith(("_fastqc", "_fastqc.zip")):
+        return "fastqc"
+    parts = basename.lower().split(".")
+    if guess_compress_type(basename) != "none":
+        parts = parts[:-1]
+    format = format_map.get(parts[-1], None) if len(parts) > 1 else None
+    if format is None:
+        raise ValueError("cannot guess the format of {input_file}, please specify it".format(input_file=input_file))
+    return format
+
+
+def parse_size(size):
+    """ parse a memory size like `512M`, `10G` or `2048` (bytes) into bytes """
+
+    units = {"": 1, "B": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = str(size).strip().upper()
+    if size.endswith("IB"):
+        size = size[:-2]
+    elif size.endswith("B"):
+        size = size[:-1]
+    number, unit = size, ""
+    if size and size[-1] in units:
+        number, unit = size[:-1], size[-1]
+    try:
+        return int(float(number) * units[unit])
+    except ValueError:
+        raise ValueError("invalid memory size: {size}".format(size=size))
+
+
+def validate_size(ctx, param, value):
+    """ click callback parsing a memory size option, see `parse_size` """
+
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 def setup_logging(loglevel):
     """Setup basic loggings
     Args:
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""Result writers with a fixed, merge-friendly schema.
+
+Every counter turns its result into records (see `ReadCounter.to_records`),
+the writers below store them as rows of `RESULT_FIELDS`, one row per sample,
+or per contig for bam input. All writers can append to an existing output
+file, and appends from concurrent processes are serialized with a lock, so
+that batch runs can collect many samples in a single artifact.
+"""
+
+
+import os
+import json
+import fcntl
+import tempfile
+from itertools import islice
+from contextlib import contextmanager
+
+
+# column order of the result schema, missing values are written as null/empty,
+# `group` holds the tag value of bam counts grouped by tag, `region`, `start`
+# and `end` the name and 0-based, half-open coordinates of bam counts per region
+RESULT_FIELDS = ("sample", "format", "contig", "length", "numreads", "raw_reads", "group", "region", "start", "end")
+
+
+def result_rows(records):
+    """Project `records` onto `RESULT_FIELDS`, yielding tuples."""
+    for record in records:
+        yield tuple(record.get(field, None) for field in RESULT_FIELDS)
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on `path`.lock for the duration of the block."""
+    with open(path + ".lock", "a") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
+class ResultWriter(object):
+    """Write result records to `path`.
+
+    Records may be a generator, they are consumed one at a time (or one batch
+    at a time for the columnar formats) and never collected in a list.
+
+    Attributes:
+        path (str): output file
+        append (bool): append to `path` if it exists instead of overwriting it
+    """
+
+    suffix = None
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+
+    def write(self, records):
+        with _locked(self.path):
+            self._write(records)
+
+    def _write(self, records):
+        raise NotImplementedError
+
+
+class JsonLinesWriter(ResultWriter):
+    """One JSON object per record, keys beyond `RESULT_FIELDS` (e.g., `length_histogram`) are kept."""
+
+    suffix = ".jsonl"
+
+    def _write(self, records):
+        with open(self.path, "a" if self.append else "w") as oh:
+            for record in records:
+                row = dict.fromkeys(RESULT_FIELDS)
+                row.update(record)
+                oh.write(json.dumps(row) + "\n")
+
+
+class TsvWriter(ResultWriter):
+    """Tab separated `RESULT_FIELDS` with a header line, written once per file."""
+
+    suffix = ".tsv"
+
+    def _write(self, records):
+        with open(self.path, "a" if self.append else "w") as oh:
+            if oh.tell() == 0:
+                oh.write("\t".join(RESULT_FIELDS) + "\n")
+            for row in result_rows(records):
+                oh.write("\t".join("" if value is None else str(value) for value in row) + "\n")
+
+
+class _ArrowWriter(ResultWriter):
+    """Base of the columnar writers, requires pyarrow.
+
+    Records are converted and written in batches of `batch_size` rows. Columnar
+    files cannot be appended in place, the batches of the existing file are
+    copied to a new file, followed by the new ones, which then atomically
+    replaces the old file while holding the lock.
+    """
+
+    batch_size = 1 << 16
+
+    def __init__(self, path, append=False):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("pyarrow is required for {suffix} output, please install it at first".format(
+                suffix=self.suffix))
+        super().__init__(path, append)
+
+    @staticmethod
+    def _schema():
+        import pyarrow as pa
+        return pa.schema([("sample", pa.string()), ("format", pa.string()), ("contig", pa.string()),
+                          ("length", pa.int64()), ("numreads", pa.int64()), ("raw_reads", pa.int64()),
+                          ("group", pa.string()), ("region", pa.string()), ("start", pa.int64()),
+                          ("end", pa.int64())])
+
+    def _batches(self, records, schema):
+        import pyarrow as pa
+
+        rows = result_rows(records)
+        while True:
+            chunk = list(islice(rows, self.batch_size))
+            if not chunk:
+                return
+            yield pa.RecordBatch.from_arrays([pa.array(list(column), type=field.type)
+                                              for column, field in zip(zip(*chunk), schema)], schema=schema)
+
+    def _write(self, records):
+        import pyarrow as pa
+
+        schema = self._schema()
+        out_dir = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_file = tempfile.mkstemp(dir=out_dir, suffix=self.suffix)
+        os.close(fd)
+        try:
+            with self._open_writer(tmp_file, schema) as writer:
+                if self.append and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                    for batch in self._read_batches():
+                        writer.write_table(pa.Table.from_batches([batch]).cast(schema))
+                for batch in self._batches(records, schema):
+                    writer.write_batch(batch)
+            os.replace(tmp_file, self.path)
+        except Exception:
+            os.unlink(tmp_file)
+            raise
+
+
+class ParquetWriter(_ArrowWriter):
+
+    suffix = ".parquet"
+
+    def _read_batches(self):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(self.path).iter_batches(batch_size=self.batch_size)
+
+    def _open_writer(self, path, schema):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema)
+
+
+class FeatherWriter(_ArrowWriter):
+
+    suffix = ".feather"
+
+    def _read_batches(self):
+        import pyarrow as pa
+        with pa.memory_map(self.path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i)
+
+    def _open_writer(self, path, schema):
+        # feather version 2 is the Arrow IPC file format, compressed with lz4 like `write_feather`
+        import pyarrow as pa
+        options = pa.ipc.IpcWriteOptions(compression="lz4") if pa.Codec.is_available("lz4") else None
+        return pa.ipc.new_file(path, schema, options=options)
+
+
+writer_map = {"jsonl": JsonLinesWriter,
+              "tsv": TsvWriter,
+              "parquet": ParquetWriter,
+              "feather": FeatherWriter
+              }
+
+
+def get_writer(output_format, path, append=False):
+    """Create the writer registered for `output_format` in `writer_map`."""
+    _Writer = writer_map.get(output_format, None)
+    if _Writer is None:
+        raise ValueError("unsupported output format: {format}".format(format=output_format))
+    return _Writer(path, append=append)
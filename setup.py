@@ -25,7 +25,7 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
     description="read counting for different file types",
     entry_points={
@@ -34,13 +34,15 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={'arrow': ['pyarrow']},
+    python_requires='>=3.7',
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
     keywords='readcounter',
     name='readcounter',
     packages=find_packages(include=['readcounter']),
-    package_data={'readcounter': ['data/*.*', 'VERSION']},
+    package_data={'readcounter': ['data/*.*']},
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
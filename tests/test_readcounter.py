@@ -3,6 +3,7 @@
 
 """Tests for `readcounter` package."""
 import os
+import sys
 import pytest
 import traceback
 import subprocess
@@ -176,7 +177,7 @@ def test_input_fastqc_zip(runner):
 
 def test_input_bam_file(runner):
     input_file = pkg_resources.resource_filename(__name__, 'test_data/test.bam')
-    input_count_file = pkg_resources.resource_filename(__name__, 'test_data/bam_read_number.txt')
+    input_count_file = pkg_resources.resource_filename(__name__, 'test_results/test_bam_read_number.txt')
     output_dir = "./tests/test_results"
     output_prefix = "test_input_bam_file"
     result = runner.invoke(cli.main, ['bam', 
@@ -190,3 +191,575 @@ def test_input_bam_file(runner):
     read_count = open(output_file, 'r').read()
     ret_code = subprocess.check_call("diff {in_count} {out_count}".format(in_count=input_count_file, out_count=output_file), shell=True)
     assert ret_code == 0
+
+
+@pytest.mark.parametrize("subcommand,input_file", [
+    ("fasta", "test_data/test.fasta"),
+    ("fastq", "test_data/test.fq.gz"),
+    ("fastqc", "test_data/sample1_fastqc.zip"),
+])
+def test_startup_skips_heavy_imports(tmp_path, subcommand, input_file):
+    """fasta/fastq/fastqc runs must never pay for importing pysam or pandas"""
+    input_file = pkg_resources.resource_filename(__name__, input_file)
+    script = ("import sys\n"
+              "from click.testing import CliRunner\n"
+              "from readcounter import cli\n"
+              "result = CliRunner().invoke(cli.main, {args!r})\n"
+              "assert result.exit_code == 0, result.output\n"
+              "print(' '.join(m for m in ('pysam', 'pandas', 'numpy') if m in sys.modules))\n"
+              ).format(args=[subcommand, '--output_dir', str(tmp_path), '--force', input_file])
+    output = subprocess.check_output([sys.executable, "-c", script], cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert output.strip() == b''
+
+
+@pytest.fixture
+def counting_server(tmp_path):
+    from readcounter.server import CountingServer
+    import threading
+    server = CountingServer(str(tmp_path / "rc.sock"), workers=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_server_request_count(counting_server):
+    from readcounter.server import request_count
+    input_file = get_test_input_file(format='fq', compress_type='gz')
+    records = request_count('fastq', input_file, socket_path=counting_server.socket_path)
+    assert records == [{'sample': 'test', 'format': 'fastq', 'numreads': 250}]
+    # the second request is answered from the result cache
+    assert request_count('fastq', input_file, socket_path=counting_server.socket_path) == records
+    assert len(counting_server._cache) == 1
+    with pytest.raises(RuntimeError):
+        request_count('fastq', input_file + '.missing', socket_path=counting_server.socket_path)
+    with pytest.raises(RuntimeError):
+        request_count('fastq', input_file + '; touch injected', socket_path=counting_server.socket_path)
+    assert not os.path.exists('injected')
+    assert os.stat(counting_server.socket_path).st_mode & 0o777 == 0o600
+
+
+def test_client_uses_server(runner, counting_server, tmp_path):
+    input_file = get_test_input_file(format="fasta")
+    result = runner.invoke(cli.main, ['client', '-t', 'fasta',
+                                      '--socket', counting_server.socket_path,
+                                      '--output_dir', str(tmp_path), input_file])
+    assert result.exit_code == 0
+    assert (tmp_path / "test.txt").read_text() == 'test : 250\n'
+    assert len(counting_server._cache) == 1
+
+
+def test_client_reports_server_errors(runner, counting_server, tmp_path):
+    fasta_file = tmp_path / "test.fasta"
+    fasta_file.write_text(">r1\nACGT\n")
+    result = runner.invoke(cli.main, ['client', '-t', 'bam',
+                                      '--socket', counting_server.socket_path,
+                                      '--output_dir', str(tmp_path / "out"), str(fasta_file)])
+    assert result.exit_code != 0
+    assert 'readcounter server failed' in result.output
+
+
+def test_client_falls_back_without_server(runner, tmp_path):
+    input_file = get_test_input_file(format="fasta")
+    result = runner.invoke(cli.main, ['client', '-t', 'fasta',
+                                      '--socket', str(tmp_path / "absent.sock"),
+                                      '--output_dir', str(tmp_path), input_file])
+    assert result.exit_code == 0
+    assert (tmp_path / "test.txt").read_text() == 'test : 250\n'
+
+
+def test_bam_counter_resolved_lazily():
+    import readcounter as rc
+    from readcounter.bam import BamReadCounter
+    assert rc.BamReadCounter is BamReadCounter
+    assert readcounter.CounterDispatcher.get_counter('sam') is BamReadCounter
+    with pytest.raises(ValueError):
+        readcounter.CounterDispatcher.get_counter('cram')
+
+
+def test_samfile_cache_is_bounded(tmp_path, monkeypatch):
+    from collections import OrderedDict
+    from readcounter.bam import BamReadCounter
+    monkeypatch.setattr(BamReadCounter, "samfile_cache", OrderedDict())
+    monkeypatch.setattr(BamReadCounter, "samfile_cache_size", 1)
+    input_file = pkg_resources.resource_filename(__name__, 'test_data/test.bam')
+    copy_file = str(tmp_path / "copy.bam")
+    with open(input_file, 'rb') as ih, open(copy_file, 'wb') as oh:
+        oh.write(ih.read())
+    first = BamReadCounter(input_file, None)._open_samfile()
+    assert BamReadCounter(input_file, None)._open_samfile() is first
+    BamReadCounter(copy_file, None)._open_samfile()
+    assert first.closed
+    assert len(BamReadCounter.samfile_cache) == 1
+
+
+def test_run_batch_largest_first(tmp_path):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from readcounter.scheduler import CountJob, run_batch, count_files_async
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        """records the input files of counting jobs in the order they are started"""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.started = []
+
+        def submit(self, fn, *args, **kwargs):
+            if fn.__name__ == "_run_job":
+                self.started.append(args[0])
+            return super().submit(fn, *args, **kwargs)
+
+    # smallest first, so that the start order has to be changed
+    input_files = [get_test_input_file(format='fq', compress_type='bz2'),
+                   get_test_input_file(format='fq', compress_type='gz'),
+                   get_test_input_file(format='fasta'),
+                   get_test_input_file(format='fastq')]
+    jobs = [CountJob(input_file, 'fasta' if input_file.endswith('.fasta') else 'fastq',
+                     compress_type=input_file.rsplit('.', 1)[-1] if input_file.endswith(('gz', 'bz2')) else 'none')
+            for input_file in input_files]
+    with RecordingExecutor(max_workers=1) as executor:
+        asyncio.run(count_files_async(jobs, concurrency=1, io_executor=executor, cpu_executor=executor))
+    assert executor.started == input_files[::-1]
+    assert [job.records[0]['numreads'] for job in jobs] == [250] * 4
+
+    jobs = [CountJob(get_test_input_file(format='fasta'), 'fasta'),
+            CountJob(get_test_input_file(format='fq', compress_type='gz'), 'fastq', compress_type='gz',
+                     out_file=str(tmp_path / "test.txt")),
+            CountJob(get_test_input_file(format='fastq'), 'fastq'),
+            CountJob(str(tmp_path / "missing.fq"), 'fastq')]
+    run_batch(jobs, concurrency=4, workers=1)
+    assert [job.records[0]['numreads'] for job in jobs[:3]] == [250, 250, 250]
+    assert isinstance(jobs[3].error, OSError)
+    assert (tmp_path / "test.txt").read_text() == 'test : 250\n'
+
+
+def test_batch_subcommand(runner, tmp_path):
+    input_files = [get_test_input_file(format='fq', compress_type=compress_type) for compress_type in ('gz', 'bz2')]
+    result = runner.invoke(cli.main, ['batch', '-t', 'fastq', '-o', str(tmp_path), '-w', '1'] + input_files)
+    assert result.exit_code != 0  # both inputs map to the same output file
+    assert 'same output file' in result.output
+    assert not (tmp_path / "test.txt").exists()
+    result = runner.invoke(cli.main, ['batch', '-t', 'fastq', '-o', str(tmp_path / "out"), '-w', '1',
+                                      get_test_input_file(format='fastq')])
+    if result.exception:
+        traceback.print_exception(*result.exc_info)
+    assert result.exit_code == 0
+    assert (tmp_path / "out" / "test.txt").read_text() == 'test : 250\n'
+
+
+def test_fastq_scanner_validation(tmp_path):
+    import gzip
+    from readcounter.scanner import count_fastq, FormatError
+    records = b"@r1\nACGT\n+\n@@II\n@r2\nAC\nGT\n+r2\nII\nII\n@r3\n\n+\n\n"
+    fastq = tmp_path / "multi.fq"
+    fastq.write_bytes(records * 3)
+    # qualities starting with '@', multi-line and empty records
+    for block_size in (1, 5, 1 << 20):
+        assert count_fastq(str(fastq), block_size=block_size) == 9
+    fastq.write_bytes(records.replace(b"\n", b"\r\n"))
+    assert count_fastq(str(fastq)) == 3
+    fastq.write_bytes(b"@r1\nACGT\n+\nIIII\n@r2\nACGT\n+\nIIIII\n")
+    with pytest.raises(FormatError) as e:
+        count_fastq(str(fastq))
+    assert e.value.offset == 16
+    fastq.write_bytes(b"@r1\nACGT\n+\nIIII\n@r2\nACGT\n")
+    with pytest.raises(FormatError) as e:
+        count_fastq(str(fastq))
+    assert e.value.offset == 16
+    fastq.write_bytes(b"")
+    assert count_fastq(str(fastq)) == 0
+    truncated = tmp_path / "truncated.fq.gz"
+    truncated.write_bytes(gzip.compress(records * 1000)[:-100])
+    with pytest.raises(FormatError):
+        count_fastq(str(truncated), compress_type='gz')
+    zipped = open(get_test_input_file("fq", "zip"), "rb").read()
+    truncated = tmp_path / "truncated.fq.zip"
+    truncated.write_bytes(zipped[:len(zipped) // 2])
+    with pytest.raises(FormatError) as e:
+        count_fastq(str(truncated), compress_type='zip')
+    assert e.value.offset == 0
+
+
+def test_fasta_scanner_validation(tmp_path):
+    from readcounter.scanner import count_fasta, FormatError
+    fasta = tmp_path / "test.fa"
+    fasta.write_bytes(b">r1\r\nACGT\r\nACGT\r\n>r2\r\nAC\r\n")
+    for block_size in (1, 3, 1 << 20):
+        assert count_fasta(str(fasta), block_size=block_size) == 2
+    fasta.write_bytes(b"\n@r1\nACGT\n")
+    with pytest.raises(FormatError) as e:
+        count_fasta(str(fasta))
+    assert e.value.offset == 1
+
+
+def test_invalid_fastq_input(runner, tmp_path):
+    fastq = tmp_path / "bad.fq"
+    fastq.write_bytes(b"ACGT\n")
+    result = runner.invoke(cli.main, ['fastq', '--output_dir', str(tmp_path), str(fastq)])
+    assert result.exit_code != 0
+    assert 'byte offset 0' in result.output
+    zipped = open(get_test_input_file("fq", "zip"), "rb").read()
+    fastq = tmp_path / "half.fq.zip"
+    fastq.write_bytes(zipped[:len(zipped) // 2])
+    result = runner.invoke(cli.main, ['fastq', '--output_dir', str(tmp_path), str(fastq)])
+    assert result.exit_code == 1
+    assert 'invalid fastq input' in result.output and 'corrupt zip archive' in result.output
+
+
+def test_fastq_length_and_quality_filters(runner, tmp_path, monkeypatch):
+    from readcounter.scanner import filter_fastq, FilteringFastqScanner
+    fastq = tmp_path / "reads.fq"
+    # lengths 4, 4, 2 (multi-line), 6; mean qualities 40, 10, 40, 40
+    fastq.write_bytes(b"@r1\nACGT\n+\nIIII\n@r2\nACGT\n+\n++++\n@r3\nA\nC\n+\nI\nI\n"
+                      b"@r4\r\nACGTAC\r\n+\r\nIIIIII\r\n")
+    for batch_size in (1, 1 << 16):
+        monkeypatch.setattr(FilteringFastqScanner, "batch_size", batch_size)
+        scanner = filter_fastq(str(fastq), min_read_len=3, min_base_qual=30)
+        assert (scanner.count, scanner.passed) == (4, 2)
+        assert scanner.length_histogram == [(2, 1), (4, 2), (6, 1)]
+    result = runner.invoke(cli.main, ['fastq', '--min_read_len', '3', '--min_base_qual', '30',
+                                      '--output_dir', str(tmp_path), str(fastq)])
+    assert result.exit_code == 0
+    assert (tmp_path / "reads.txt").read_text() == \
+        'reads : 2\nraw_reads : 4\nlength_histogram : 2:1,4:2,6:1\n'
+
+
+def _append_tsv(path, sample):
+    from readcounter.writers import TsvWriter
+    TsvWriter(path, append=True).write([{'sample': sample, 'format': 'fastq', 'numreads': 1}])
+
+
+def test_tsv_writer_concurrent_appends(tmp_path):
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    out_file = str(tmp_path / "results.tsv")
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context("forkserver")) as executor:
+        list(executor.map(_append_tsv, [out_file] * 40, ['s{0}'.format(i) for i in range(40)]))
+    lines = open(out_file).read().splitlines()
+    assert lines[0] == 'sample\tformat\tcontig\tlength\tnumreads\traw_reads\tgroup\tregion\tstart\tend'
+    assert sorted(lines[1:]) == sorted('s{0}\tfastq\t\t\t1\t\t\t\t\t'.format(i) for i in range(40))
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_columnar_writers_append(tmp_path, output_format):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+    from readcounter.writers import get_writer
+    out_file = str(tmp_path / ("results." + output_format))
+    get_writer(output_format, out_file).write([{'sample': 'a', 'format': 'fasta', 'numreads': 3}])
+    get_writer(output_format, out_file, append=True).write(
+        [{'sample': 'b', 'format': 'bam', 'contig': 'c1', 'length': 10, 'numreads': 2}])
+    read_table = pq.read_table if output_format == "parquet" else feather.read_table
+    assert read_table(out_file).to_pylist() == [
+        {'sample': 'a', 'format': 'fasta', 'contig': None, 'length': None, 'numreads': 3, 'raw_reads': None,
+         'group': None, 'region': None, 'start': None, 'end': None},
+        {'sample': 'b', 'format': 'bam', 'contig': 'c1', 'length': 10, 'numreads': 2, 'raw_reads': None,
+         'group': None, 'region': None, 'start': None, 'end': None}]
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "parquet", "feather"])
+def test_writers_consume_generators(tmp_path, monkeypatch, output_format):
+    if output_format != "tsv":
+        pytest.importorskip("pyarrow")
+    from readcounter import writers
+    monkeypatch.setattr(writers._ArrowWriter, "batch_size", 3)
+    out_file = str(tmp_path / ("results." + output_format))
+
+    def records(sample, n):
+        for i in range(n):
+            yield {'sample': sample, 'format': 'bam', 'contig': 'c{0}'.format(i), 'length': 10, 'numreads': i}
+
+    writers.get_writer(output_format, out_file).write(records('a', 7))
+    writers.get_writer(output_format, out_file, append=True).write(records('b', 5))
+    if output_format == "tsv":
+        rows = [line.split("\t")[:5] for line in open(out_file).read().splitlines()[1:]]
+    else:
+        import pyarrow.parquet as pq
+        import pyarrow.feather as feather
+        table = (pq.read_table if output_format == "parquet" else feather.read_table)(out_file)
+        rows = [[str(row[field]) for field in ('sample', 'format', 'contig', 'length', 'numreads')]
+                for row in table.to_pylist()]
+    assert rows == ([['a', 'bam', 'c{0}'.format(i), '10', str(i)] for i in range(7)] +
+                    [['b', 'bam', 'c{0}'.format(i), '10', str(i)] for i in range(5)])
+
+
+def test_jsonl_output_appends(runner, tmp_path):
+    import json
+    for input_file in (get_test_input_file(format='fq', compress_type='gz'), get_test_input_file(format='fasta')):
+        result = runner.invoke(cli.main, ['fastq' if 'fq' in input_file else 'fasta', '-O', 'jsonl', '-a',
+                                          '-p', 'all', '-o', str(tmp_path), input_file])
+        assert result.exit_code == 0
+    rows = [json.loads(line) for line in (tmp_path / "all.jsonl").read_text().splitlines()]
+    assert [(row['format'], row['numreads']) for row in rows] == [('fastq', 250), ('fasta', 250)]
+    result = runner.invoke(cli.main, ['fasta', '-a', '-o', str(tmp_path), get_test_input_file(format='fasta')])
+    assert result.exit_code != 0
+
+
+def test_batch_single_tsv_output(runner, tmp_path):
+    input_files = [get_test_input_file(format='fq', compress_type=compress_type) for compress_type in ('gz', 'bz2')]
+    result = runner.invoke(cli.main, ['batch', '-t', 'fastq', '-O', 'tsv', '-o', str(tmp_path), '-w', '1'] + input_files)
+    assert result.exit_code == 0
+    assert (tmp_path / "readcounter.tsv").read_text().splitlines()[1:] == ['test\tfastq\t\t\t250\t\t\t\t\t'] * 2
+
+
+def make_test_bam(path, reads):
+    """write a sorted, indexed bam with two contigs, `reads` are (contig id, start, length, tags) tuples"""
+    import pysam
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'c1', 'LN': 1000}, {'SN': 'c2', 'LN': 2000}]}
+    with pysam.AlignmentFile(path, "wb", header=header) as oh:
+        for i, (tid, start, length, tags) in enumerate(sorted(reads, key=lambda read: read[:2])):
+            aln = pysam.AlignedSegment(oh.header)
+            aln.query_name = "r{0}".format(i)
+            aln.query_sequence = "A" * length
+            aln.query_qualities = pysam.qualitystring_to_array("I" * length)
+            aln.reference_id = tid
+            aln.reference_start = start
+            aln.cigarstring = "{0}M".format(length)
+            aln.mapping_quality = 60
+            aln.set_tags(tags)
+            oh.write(aln)
+    pysam.index(path)
+    return path
+
+
+def test_bam_min_base_qual(tmp_path, caplog):
+    import pysam
+    from readcounter import bam
+    bam_file = make_test_bam(str(tmp_path / "quals.bam"), [(0, 10, 50, []), (0, 20, 50, [])])
+    # a copy where the second read is stored without qualities
+    no_quals = str(tmp_path / "no_quals.bam")
+    with pysam.AlignmentFile(bam_file) as fh, pysam.AlignmentFile(no_quals, "wb", template=fh) as oh:
+        for i, aln in enumerate(fh):
+            if i == 1:
+                aln.query_qualities = None
+            oh.write(aln)
+    pysam.index(no_quals)
+    counter = bam.BamReadCounter(no_quals, None, min_base_qual=30)
+    counter.count_read_number()
+    assert [record["numreads"] for record in counter.to_records()] == [1]
+    # bamcov would apply the threshold per base, the mean read quality is computed with pysam
+    counter = bam.BamReadCounter(bam_file, None, min_base_qual=30, use_bamcov=True)
+    counter.count_read_number()
+    assert [record["numreads"] for record in counter.to_records()] == [2]
+    assert "mean read quality" in caplog.text
+
+
+def test_sparse_counter_folds():
+    import numpy as np
+    from readcounter.bam import _SparseCounter
+    keys = [(2 << 32) | 1, 5, (2 << 32) | 1, 7, 5, 5]
+    # a buffer of one key folds after every add
+    for buffer_size in (1, 4, 1 << 20):
+        counter = _SparseCounter(buffer_size=buffer_size)
+        for key in keys:
+            counter.add(key)
+        unique, counts = counter.result()
+        assert unique.tolist() == [5, 7, (2 << 32) | 1]
+        assert counts.tolist() == [3, 1, 2]
+        assert counts.dtype == np.int64
+
+
+def test_bam_group_by_tag(runner, tmp_path):
+    bam_file = make_test_bam(str(tmp_path / "cells.bam"), [
+        (0, 10, 50, [('CB', 'AAA')]), (0, 20, 50, [('CB', 'AAA')]), (0, 30, 50, [('CB', 'CCC')]),
+        (1, 10, 50, [('CB', 'CCC')]), (1, 40, 50, [('CB', 'GGG')]), (1, 50, 50, [])])
+    result = runner.invoke(cli.main, ['bam', '--group_by_tag', 'CB', '-o', str(tmp_path), bam_file])
+    if result.exception:
+        traceback.print_exception(*result.exc_info)
+    assert result.exit_code == 0
+    assert (tmp_path / "cells.txt").read_text().splitlines() == [
+        'contig\tlength\tCB\tnumreads', 'c1\t1000\tAAA\t2', 'c1\t1000\tCCC\t1', 'c2\t2000\tCCC\t1', 'c2\t2000\tGGG\t1']
+    result = runner.invoke(cli.main, ['bam', '--group_by_tag', 'CB', '-O', 'jsonl', '-o', str(tmp_path), bam_file])
+    assert result.exit_code == 0
+    assert '"group": "GGG"' in (tmp_path / "cells.jsonl").read_text()
+
+
+def test_bam_regions(runner, tmp_path):
+    bam_file = make_test_bam(str(tmp_path / "genes.bam"), [
+        (0, 10, 50, []), (0, 100, 50, []), (0, 180, 50, []), (0, 500, 50, []),
+        (1, 10, 50, []), (1, 1500, 50, [])])
+    bed_file = tmp_path / "genes.bed"
+    # geneA and geneB overlap, the read at 180-230 spans geneB and geneC
+    bed_file.write_text("track name=genes\n"
+                        "c1\t0\t120\tgeneA\n"
+                        "c1\t90\t200\tgeneB\n"
+                        "c1\t220\t400\tgeneC\n"
+                        "c1\t560\t900\tgeneD\n"
+                        "c2\t1400\t1600\n"
+                        "c3\t0\t100\tgeneE\n")
+    result = runner.invoke(cli.main, ['bam', '--regions', str(bed_file), '-o', str(tmp_path), bam_file])
+    if result.exception:
+        traceback.print_exception(*result.exc_info)
+    assert result.exit_code == 0
+    assert (tmp_path / "genes.txt").read_text().splitlines() == [
+        'contig\tstart\tend\tname\tnumreads',
+        'c1\t0\t120\tgeneA\t2', 'c1\t90\t200\tgeneB\t2', 'c1\t220\t400\tgeneC\t1', 'c1\t560\t900\tgeneD\t0',
+        'c2\t1400\t1600\tc2:1400-1600\t1', 'c3\t0\t100\tgeneE\t0']
+    result = runner.invoke(cli.main, ['bam', '--regions', str(bed_file), '--group_by_tag', 'CB',
+                                      '-o', str(tmp_path), '-f', bam_file])
+    assert result.exit_code != 0
+
+
+def test_parse_size():
+    from readcounter.utils import parse_size
+    assert parse_size("2048") == 2048
+    assert parse_size("512K") == 512 << 10
+    assert parse_size("1.5g") == 3 << 29
+    assert parse_size("10GiB") == 10 << 30
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+@pytest.mark.parametrize("options", [['--low_memory'], ['--max_memory', '64K'], ['--low_memory', '--use_bamcov']])
+def test_bam_low_memory(runner, tmp_path, options):
+    from readcounter import bam
+    bam_file = make_test_bam(str(tmp_path / "big.bam"), [(0, 10, 50, []), (0, 20, 50, []), (1, 10, 50, [])])
+    result = runner.invoke(cli.main, ['bam'] + options + ['-o', str(tmp_path), bam_file])
+    if result.exception:
+        traceback.print_exception(*result.exc_info)
+    assert result.exit_code == 0
+    assert (tmp_path / "big.txt").read_text().splitlines() == [
+        'contig\tlength\tnumreads', 'c1\t1000\t2', 'c2\t2000\t1']
+    assert sorted(os.listdir(str(tmp_path))) == ["big.bam", "big.bam.bai", "big.txt"]
+    counter = bam.BamReadCounter(bam_file, None, max_memory="64K")
+    assert counter._buffer_size() == 1024
+    counter.count_read_number()
+    assert isinstance(counter.read_count, bam._ContigTable) and len(counter.read_count) == 2
+    records = counter.to_records()
+    assert not isinstance(records, list)
+    assert [record["numreads"] for record in records] == [2, 1]
+    result = runner.invoke(cli.main, ['bam', '--max_memory', 'lots', '-o', str(tmp_path), '-f', bam_file])
+    assert result.exit_code == 2
+    assert "Invalid value for '--max_memory'" in result.output
+
+
+def test_bam_regions_buffered(tmp_path, monkeypatch):
+    from readcounter import bam
+    bam_file = make_test_bam(str(tmp_path / "genes.bam"), [(0, start, 50, []) for start in range(0, 900, 10)])
+    bed_file = tmp_path / "genes.bed"
+    bed_file.write_text("c1\t0\t100\tgeneA\nc1\t50\t500\tgeneB\nc1\t800\t1000\tgeneC\n")
+    expected = bam.BamReadCounter(bam_file, None, regions=str(bed_file))
+    expected.count_read_number()
+    # count the buffered read coordinates every 3 reads
+    monkeypatch.setattr(bam, "_LOW_MEMORY_BUFFER_SIZE", 3)
+    counter = bam.BamReadCounter(bam_file, None, regions=str(bed_file), low_memory=True)
+    counter.count_read_number()
+    assert list(counter.to_records()) == list(expected.to_records())
+    assert [record["numreads"] for record in counter.to_records()] == [10, 49, 14]
+
+
+def test_guess_format():
+    from readcounter.utils import guess_format
+    assert guess_format("a/sample.fq.gz") == "fastq"
+    assert guess_format("sample.FASTA.bz2") == "fasta"
+    assert guess_format("sample.bam") == "bam"
+    assert guess_format("sample_fastqc.zip") == "fastqc"
+    assert guess_format(pkg_resources.resource_filename(__name__, "test_data/sample2_fastqc")) == "fastqc"
+    with pytest.raises(ValueError):
+        guess_format("sample.txt")
+
+
+def test_api_count(tmp_path, monkeypatch):
+    import shutil
+    import readcounter as rc
+
+    def no_subprocess(*args, **kwargs):
+        raise AssertionError("the library API must not run subprocesses")
+    monkeypatch.setattr(subprocess, "Popen", no_subprocess)
+    # fastqc archives are read in place, paths with spaces included
+    fastqc_zip = str(tmp_path / "my sample_fastqc.zip")
+    shutil.copy(pkg_resources.resource_filename(__name__, "test_data/sample1_fastqc.zip"), fastqc_zip)
+    result = rc.count(fastqc_zip)
+    assert (result.format, result.numreads) == ("fastqc", 12733986)
+    assert os.listdir(str(tmp_path)) == ["my sample_fastqc.zip"]
+    result = rc.count(get_test_input_file("fq", "gz"), min_read_len=10 ** 6)
+    assert isinstance(result, rc.CountResult)
+    assert result.ok and result.numreads == 0 and result.records[0]["raw_reads"] == 250
+    assert rc.count(get_test_input_file("fasta"), format="fasta").numreads == 250
+    with pytest.raises(ValueError):
+        rc.count(get_test_input_file("bam"), use_bamcov=True)
+
+
+def test_api_unindexed_bam(tmp_path):
+    import shutil
+    import readcounter as rc
+    bam_file = str(tmp_path / "x.bam")
+    shutil.copy(get_test_input_file("bam"), bam_file)
+    results = list(rc.count_many([bam_file] * 4, workers=4))
+    assert [result.numreads for result in results] == [8031] * 4
+    # the single pass gives the same counts as the indexed path
+    indexed = rc.count(get_test_input_file("bam"))
+    assert ([(r["contig"], r["length"], r["numreads"]) for r in results[0].records] ==
+            [(r["contig"], r["length"], r["numreads"]) for r in indexed.records])
+    assert os.listdir(str(tmp_path)) == ["x.bam"]
+    (tmp_path / "genes.bed").write_text("contig_1\t0\t100\n")
+    with pytest.raises(ValueError):
+        rc.count(bam_file, regions=str(tmp_path / "genes.bed"))
+    assert sorted(os.listdir(str(tmp_path))) == ["genes.bed", "x.bam"]
+
+
+def test_count_many():
+    from readcounter import count_many
+    paths = [get_test_input_file("fasta"), get_test_input_file("fq", "bz2"), "missing.fq", get_test_input_file("bam")]
+    results = {result.path: result for result in count_many(iter(paths), workers=2)}
+    assert sorted(results) == sorted(paths)
+    assert [results[path].numreads for path in paths[:2]] == [250, 250]
+    assert isinstance(results["missing.fq"].error, OSError)
+    assert results[paths[3]].format == "bam" and results[paths[3]].numreads == 8031
+
+
+def test_fastq_record_sync():
+    from readcounter.scanner import find_record_start
+    # the quality line of the first record starts with '@', as does the sequence line of the second
+    buf = b"@r1\nACGT\n+\n@@@@\n@r2\nAC\n+r2\nII\n"
+    assert find_record_start(buf, 1) == 16
+    assert find_record_start(buf, 17) == -1
+    # multi-line records cannot be synchronized on
+    assert find_record_start(b"@r1\nAC\nGT\n+\nIIII\n@r2\nAC\nGT\n+\nIIII\n", 1) == -1
+
+
+@pytest.mark.parametrize("options", [[], ['--min_read_len', '100']])
+def test_fastq_parallel_ranges(runner, tmp_path, monkeypatch, options):
+    from readcounter import scanner
+    records = ["@r{0}\n{1}\n+\n{2}\n".format(i, "ACGT" * (i % 50 + 1), "@" * 4 * (i % 50 + 1)) for i in range(2000)]
+    input_file = tmp_path / "big.fq"
+    input_file.write_text("".join(records))
+    monkeypatch.setattr(scanner, "MIN_RANGE_SIZE", 1024)
+    assert len(scanner.split_fastq(str(input_file), 4)) == 4
+    expected = runner.invoke(cli.main, ['fastq', '-p', 'serial', '-o', str(tmp_path)] + options + [str(input_file)])
+    result = runner.invoke(cli.main, ['fastq', '-w', '4', '-p', 'parallel', '-o', str(tmp_path)] + options +
+                           [str(input_file)])
+    if result.exception:
+        traceback.print_exception(*result.exc_info)
+    assert expected.exit_code == result.exit_code == 0
+    assert ((tmp_path / "parallel.txt").read_text().replace("parallel", "big") ==
+            (tmp_path / "serial.txt").read_text().replace("serial", "big"))
+    # corrupt records are reported with their offset in the whole file
+    input_file.write_text("".join(records[:1500]) + "@bad\nACGT\n+\nII\n" + "".join(records[1500:]))
+    result = runner.invoke(cli.main, ['fastq', '-w', '4', '-p', 'corrupt', '-o', str(tmp_path), str(input_file)])
+    assert result.exit_code != 0
+    assert "offset {0}".format(len("".join(records[:1500]))) in result.output
+
+
+def test_client_regions_relative_to_client(runner, counting_server, tmp_path, monkeypatch):
+    bam_file = make_test_bam(str(tmp_path / "genes.bam"), [(0, 10, 50, []), (0, 500, 50, []), (1, 10, 50, [])])
+    (tmp_path / "genes.bed").write_text("c1\t0\t100\tgeneA\n")
+    # the server and its workers keep their own working directory
+    monkeypatch.chdir(str(tmp_path))
+    args = ['client', '-t', 'bam', '--socket', counting_server.socket_path, '--regions', 'genes.bed',
+            '-o', 'out', '-f', bam_file]
+    result = runner.invoke(cli.main, args)
+    if result.exception:
+        traceback.print_exception(*result.exc_info)
+    assert result.exit_code == 0
+    assert (tmp_path / "out" / "genes.txt").read_text().splitlines()[1:] == ['c1\t0\t100\tgeneA\t1']
+    # editing the BED file invalidates the cached counts
+    (tmp_path / "genes.bed").write_text("c1\t0\t1000\tgeneA\nc2\t0\t100\tgeneB\n")
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0
+    assert (tmp_path / "out" / "genes.txt").read_text().splitlines()[1:] == [
+        'c1\t0\t1000\tgeneA\t2', 'c2\t0\t100\tgeneB\t1']